@@ -0,0 +1,122 @@
+'''
+Times the maximal segments kernel on genome sized synthetic scores for
+several bin sizes and writes the results as JSON:
+
+    python -m benchmarks.max_segments_kernel -o kernel.json
+    python -m benchmarks.max_segments_kernel --compare kernel.json
+
+With --compare, the speed of each bin size is reported relative to an
+earlier result file (e.g. made at another commit).
+
+The scores are drawn from two normal distributions, a slightly negative
+one for the background and a positive one within enriched domains, so
+the number and length of the segments resemble those of real data.
+'''
+import sys
+import json
+import time
+import argparse
+import platform
+import multiprocessing
+import numpy as np
+
+from benchmarks.run_benchmarks import git_commit
+from eddlib.instrument import proc_status_mb, reset_peak_rss
+
+
+def synthetic_bins(genome_size, bin_size, nchroms, domain_fraction,
+                   domain_size, seed):
+    '''GenomeBins with one segment per chromosome of equal length'''
+    from eddlib.algorithm.max_segments import GenomeBins
+    rs = np.random.RandomState(seed)
+    nbins = genome_size // bin_size
+    # alternating background and domain runs of exponential length
+    mean_domain = max(1, domain_size // bin_size)
+    mean_background = mean_domain * (1 - domain_fraction) / domain_fraction
+    nruns = int(2 * nbins / (mean_domain + mean_background)) + 2
+    lengths = np.ones(nruns) + rs.exponential(1, nruns) * np.where(
+        np.arange(nruns) % 2 == 0, mean_background, mean_domain)
+    ends = np.minimum(np.cumsum(lengths.astype(np.int64)), nbins)
+    in_domain = np.zeros(nbins + 1, dtype=np.int8)
+    np.add.at(in_domain, ends[:-1], 1)
+    in_domain = np.cumsum(in_domain[:nbins]) % 2 == 1
+    scores = rs.normal(-0.2, 1, nbins)
+    scores[in_domain] += 0.6
+    names = ['chr%d' % (i + 1) for i in range(nchroms)]
+    offsets = np.linspace(0, nbins, nchroms + 1).astype(np.intp)
+    starts = np.zeros(nbins, dtype=np.int64)
+    for lo, hi in zip(offsets[:-1], offsets[1:]):
+        starts[lo:hi] = np.arange(hi - lo) * bin_size
+    return GenomeBins(names, names, offsets, starts, starts + bin_size, scores)
+
+def time_kernel(gb, nthreads, repeat):
+    times = []
+    reset_peak_rss()
+    for _ in range(repeat):
+        t = time.time()
+        segs = gb.segment_array(nthreads=nthreads)
+        times.append(time.time() - t)
+    return {'nbins': len(gb.scores),
+            'nsegments': len(segs),
+            'seconds': min(times),
+            'all_seconds': times,
+            'bins_per_second': len(gb.scores) / min(times),
+            'max_score': float(segs['score'].max()) if len(segs) else 0.0,
+            'peak_rss_mb': proc_status_mb('VmHWM')}
+
+def main(argv):
+    p = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    p.add_argument('-o', '--output', help='JSON result file, default stdout')
+    p.add_argument('--compare', help='an earlier JSON result file')
+    p.add_argument('--genome-size', type=float, default=3000,
+                   help='genome size in MB')
+    p.add_argument('--bin-sizes', default='1000,500,200,100',
+                   help='comma separated bin sizes in bp')
+    p.add_argument('--nchroms', type=int, default=24)
+    p.add_argument('--domain-fraction', type=float, default=0.2,
+                   help='fraction of the genome within enriched domains')
+    p.add_argument('--domain-size', type=float, default=500,
+                   help='mean domain size in KB')
+    p.add_argument('-p', '--nthreads', type=int, default=1)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--repeat', type=int, default=3,
+                   help='run each bin size this many times, the fastest is reported')
+    args = p.parse_args(argv)
+
+    results = []
+    for bin_size in [int(x) for x in args.bin_sizes.split(',')]:
+        gb = synthetic_bins(int(args.genome_size * 1e6), bin_size,
+                            args.nchroms, args.domain_fraction,
+                            int(args.domain_size * 1e3), args.seed)
+        res = time_kernel(gb, args.nthreads, args.repeat)
+        res['bin_size'] = bin_size
+        del gb
+        sys.stderr.write('bin size %6d: %10d bins %8.3fs %6.1fM bins/s\n' % (
+            bin_size, res['nbins'], res['seconds'], res['bins_per_second'] / 1e6))
+        results.append(res)
+
+    if args.compare:
+        with open(args.compare) as f:
+            earlier = {x['bin_size']: x for x in json.load(f)['results']}
+        for res in results:
+            if res['bin_size'] in earlier:
+                res['speedup'] = (res['bins_per_second'] /
+                                  earlier[res['bin_size']]['bins_per_second'])
+                sys.stderr.write('bin size %6d: %.2fx the speed of %s\n' % (
+                    res['bin_size'], res['speedup'], args.compare))
+
+    out = json.dumps({'git_commit': git_commit(),
+                      'python': platform.python_version(),
+                      'numpy': np.__version__,
+                      'platform': platform.platform(),
+                      'cpu_count': multiprocessing.cpu_count(),
+                      'parameters': vars(args),
+                      'results': results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,199 @@
+'''
+Times and memory profiles each stage of the EDD pipeline on a
+synthetic data set and writes the results as JSON, so runs can be
+compared across commits:
+
+    python -m benchmarks.run_benchmarks -o results.json --genome-size 50
+
+Memory is reported from /proc/self/status. The peak resident set size
+is reset before each stage (via /proc/self/clear_refs), so peak_rss_mb
+is the peak of that stage alone. Memory used by worker processes is
+only covered by children_peak_rss_mb, the largest worker so far.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing
+import numpy as np
+
+from benchmarks import synthetic
+from eddlib.instrument import proc_status_mb, reset_peak_rss, max_rss_mb
+from eddlib import executor
+
+
+class StageTimer(object):
+    '''runs pipeline stages and records their time and memory use'''
+
+    def __init__(self, repeat=1):
+        self.repeat = repeat
+        self.stages = []
+
+    def run(self, name, f, *args, **kwargs):
+        times = []
+        reset_peak_rss()
+        rss_before = proc_status_mb('VmRSS')
+        for _ in range(self.repeat):
+            t = time.time()
+            res = f(*args, **kwargs)
+            times.append(time.time() - t)
+        stage = {'name': name,
+                 'seconds': min(times),
+                 'all_seconds': times,
+                 'rss_before_mb': rss_before,
+                 'rss_after_mb': proc_status_mb('VmRSS'),
+                 'peak_rss_mb': proc_status_mb('VmHWM'),
+                 'children_peak_rss_mb': max_rss_mb(resource.RUSAGE_CHILDREN)}
+        self.stages.append(stage)
+        sys.stderr.write('%-28s %8.3fs\n' % (name, stage['seconds']))
+        return res
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_pipeline(dataset, args, timer):
+    from eddlib import read_bam, logit, estimate, load_params
+    from eddlib.experiment import Experiment
+    from eddlib.algorithm import unalignable_regions
+    from eddlib.algorithm.max_segments import GenomeBins, IntervalTest
+    from eddlib.algorithm.monte_carlo import MonteCarlo
+
+    config = load_params.load_parameters()
+    chromsizes = Experiment.read_chrom_sizes(dataset['chrom_sizes'])
+
+    def count(bam_path):
+        b = read_bam.BamCounter(chromsizes, bam_path, 1000)
+        b.process_bam()
+        return b.chrom_bins
+    ipd = timer.run('BamCounter.process_bam', count, dataset['ip'])
+    inputd = count(dataset['input'])
+    exp = Experiment(ipd, inputd, 1000)
+
+    def estimate_bin_size():
+        try:
+            return estimate.bin_size(exp, config['ci_method'],
+                                     nib_lim=1 - config['fraq_ibins'],
+                                     max_ci_diff=config['ci_lim'])
+        except AssertionError:
+            return None
+    bin_size = timer.run('estimate.bin_size', estimate_bin_size)
+    if args.bin_size is not None:
+        bin_size = args.bin_size * 1000
+    assert bin_size is not None, 'no bin size found, please give --bin-size'
+
+    odf = exp.aggregate_bins(new_bin_size=bin_size).as_data_frame()
+    df = timer.run('logit.ci_for_df', logit.ci_for_df, odf,
+                   config['ci_method'], ci_min=config['ci_lim'])
+    binscore_df = logit.extrapolate_low_info_bins(df)
+    df = logit.extrapolate_low_info_bins(
+        logit.neg_score_scale(df, args.gap_penalty))
+
+    gb = timer.run('GenomeBins.df_as_bins', GenomeBins.df_as_bins, df, None)
+
+    def mask():
+        # measure parsing as well, not only the cached regions
+        unalignable_regions._regions_cache.clear()
+        return gb.with_unalignable_regions_masked(dataset['unalignable_regions'])
+    gb = timer.run('unalignable_regions', mask)
+
+    observed = timer.run('GenomeBins.max_segments', gb.max_segments,
+                         filter_trivial=df.score.max(), nthreads=args.nprocs)
+    mc_res = timer.run('MonteCarlo.run_simulation', MonteCarlo.run_simulation,
+                       gb.chrom_scores, niter=args.num_trials,
+                       nprocs=args.nprocs)
+
+    def gap_penalty_search():
+        gpe = estimate.GapPenalty.instantiate(
+            binscore_df, args.nprocs, dataset['unalignable_regions'],
+            mc_trials=args.gap_penalty_trials, pval_lim=0.05)
+        return gpe.search()
+    estimated_gap_penalty = timer.run('GapPenalty.search', gap_penalty_search)
+
+    def qvalues():
+        return IntervalTest(observed, mc_res).qvalues(below=args.fdr)
+    peaks = timer.run('IntervalTest.qvalues', qvalues)
+    return {'bin_size': bin_size, 'nbins': len(df),
+            'npotential_peaks': sum(len(xs) for xs in observed.values()),
+            'npeaks': len(peaks),
+            'estimated_gap_penalty': estimated_gap_penalty}
+
+def main(argv):
+    p = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    p.add_argument('-o', '--output', help='JSON result file, default stdout')
+    p.add_argument('--data-dir', default='edd_benchmark_data',
+                   help='where the synthetic data set is written')
+    p.add_argument('--genome-size', type=float, default=20,
+                   help='genome size in MB')
+    p.add_argument('--nchroms', type=int, default=4)
+    p.add_argument('--coverage', type=float, default=0.5,
+                   help='read depth of the IP and input bam files')
+    p.add_argument('--domain-fraction', type=float, default=0.2,
+                   help='fraction of the genome within enriched domains')
+    p.add_argument('--domain-size', type=float, default=500,
+                   help='mean domain size in KB')
+    p.add_argument('--enrichment', type=float, default=2.0,
+                   help='IP read density within domains relative to outside')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--bin-size', type=int,
+                   help='bin size in KB, default is the estimated bin size')
+    p.add_argument('-g', '--gap-penalty', type=float, default=5.0)
+    p.add_argument('-n', '--num-trials', type=int, default=1000)
+    p.add_argument('--gap-penalty-trials', type=int, default=100)
+    p.add_argument('--fdr', type=float, default=0.05)
+    p.add_argument('-p', '--nprocs', type=int, default=4)
+    p.add_argument('--executor', choices=executor.kinds, default='process')
+    p.add_argument('--repeat', type=int, default=1,
+                   help='run each stage this many times, the fastest is reported')
+    args = p.parse_args(argv)
+
+    t = time.time()
+    dataset = synthetic.make_dataset(
+        args.data_dir, genome_size=int(args.genome_size * 1e6),
+        nchroms=args.nchroms, coverage=args.coverage,
+        domain_fraction=args.domain_fraction,
+        domain_size=int(args.domain_size * 1e3),
+        enrichment=args.enrichment, seed=args.seed)
+    dataset_seconds = time.time() - t
+
+    import logbook
+    timer = StageTimer(repeat=args.repeat)
+    executor.configure(args.nprocs, args.executor)
+    try:
+        with logbook.NullHandler().applicationbound():
+            summary = run_pipeline(dataset, args, timer)
+    finally:
+        executor.shutdown()
+
+    import eddlib
+    res = {'edd_version': eddlib.__version__,
+           'git_commit': git_commit(),
+           'python': platform.python_version(),
+           'numpy': np.__version__,
+           'platform': platform.platform(),
+           'cpu_count': multiprocessing.cpu_count(),
+           'parameters': vars(args),
+           'dataset': dataset,
+           'dataset_seconds': dataset_seconds,
+           'summary': summary,
+           'stages': timer.stages,
+           'total_seconds': sum(s['seconds'] for s in timer.stages)}
+    out = json.dumps(res, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,122 @@
+'''
+Times the startup of the edd command line tools and the import of the
+pipeline modules, each in a fresh interpreter, and writes the results
+as JSON:
+
+    python -m benchmarks.startup -o startup.json
+    python -m benchmarks.startup --compare startup.json --max-seconds 1
+
+Besides the time, the heavy packages (numpy, pandas, scipy.stats,
+statsmodels, ...) each command loaded are reported. With --compare,
+the time of each command is reported relative to an earlier result
+file. With --max-seconds, the exit status is 1 if any command is
+slower, so the benchmark can guard against regressions.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+from benchmarks.run_benchmarks import git_commit
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+heavy_packages = ('numpy', 'pandas', 'scipy', 'scipy.stats', 'statsmodels',
+                  'pysam', 'pkg_resources')
+
+pipeline_modules = ('eddlib.experiment', 'eddlib.load_params',
+                    'eddlib.instrument', 'eddlib.checkpoint',
+                    'eddlib.algorithm.max_segments',
+                    'eddlib.algorithm.monte_carlo', 'eddlib.estimate',
+                    'eddlib.logit', 'eddlib.tracks')
+
+# runs a script or imports modules, then prints the loaded heavy packages
+runner = '''
+import os
+import sys
+sys.stdout = open(os.devnull, 'w')
+try:
+    if sys.argv[1] == '--import':
+        for m in sys.argv[2:]:
+            __import__(m)
+    else:
+        sys.argv = sys.argv[1:]
+        execfile(sys.argv[0], {'__name__': '__main__'})
+except SystemExit:
+    pass
+finally:
+    sys.stdout = sys.__stdout__
+    print(' '.join(sorted(p for p in %r if sys.modules.get(p))))
+''' % (heavy_packages,)
+
+commands = [('edd --version', [os.path.join(root, 'bin', 'edd'), '--version']),
+            ('edd --help', [os.path.join(root, 'bin', 'edd'), '--help']),
+            ('edd batch --help', [os.path.join(root, 'bin', 'edd'), 'batch', '--help']),
+            ('edd-tools --help', [os.path.join(root, 'bin', 'edd-tools'), '--help']),
+            ('import pipeline', ['--import'] + list(pipeline_modules))]
+
+
+def time_command(argv, repeat):
+    '''best wall time of argv run by the runner and the heavy packages it loaded'''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [x for x in [env.get('PYTHONPATH')] if x])
+    times = []
+    for _ in range(repeat):
+        t = time.time()
+        out = subprocess.check_output([sys.executable, '-c', runner] + argv,
+                                      env=env, stderr=open(os.devnull, 'w'))
+        times.append(time.time() - t)
+    return {'seconds': min(times), 'all_seconds': times,
+            'loaded': out.split()}
+
+def main(argv):
+    p = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    p.add_argument('-o', '--output', help='JSON result file, default stdout')
+    p.add_argument('--compare', help='an earlier JSON result file')
+    p.add_argument('--repeat', type=int, default=5,
+                   help='run each command this many times, the fastest is reported')
+    p.add_argument('--max-seconds', type=float,
+                   help='exit with status 1 if a command takes longer')
+    args = p.parse_args(argv)
+
+    results = []
+    for name, cmd in commands:
+        res = time_command(cmd, args.repeat)
+        res['command'] = name
+        sys.stderr.write('%-18s %7.3fs  %s\n' % (name, res['seconds'],
+                                                 ' '.join(res['loaded'])))
+        results.append(res)
+
+    if args.compare:
+        with open(args.compare) as f:
+            earlier = {x['command']: x for x in json.load(f)['results']}
+        for res in results:
+            if res['command'] in earlier:
+                res['speedup'] = earlier[res['command']]['seconds'] / res['seconds']
+                sys.stderr.write('%-18s %.2fx the speed of %s\n' % (
+                    res['command'], res['speedup'], args.compare))
+
+    out = json.dumps({'git_commit': git_commit(),
+                      'python': platform.python_version(),
+                      'platform': platform.platform(),
+                      'parameters': vars(args),
+                      'results': results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+    if args.max_seconds is not None:
+        slow = [x['command'] for x in results if x['seconds'] > args.max_seconds]
+        if slow:
+            sys.stderr.write('slower than %gs: %s\n' % (args.max_seconds,
+                                                        ', '.join(slow)))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,125 @@
+'''
+Synthetic ChIP-seq data sets for benchmarking.
+
+Generates a chromosome sizes file, an unalignable regions file, the
+true enriched domains and indexed IP and input bam files. Input reads
+are spread uniformly over the genome, IP reads are enriched within
+the domains. No network access or real data is needed.
+'''
+import os
+import json
+import numpy as np
+import pysam
+
+
+def chrom_sizes(genome_size, nchroms):
+    'chromosome sizes decreasing like in most genomes'
+    weights = np.linspace(2.0, 1.0, nchroms)
+    sizes = (weights / weights.sum() * genome_size).astype(np.int64)
+    return [('chr%d' % (i + 1), int(size)) for i, size in enumerate(sizes)]
+
+def random_domains(rs, chroms, domain_fraction, domain_size):
+    '''
+    non-overlapping domains per chromosome with exponentially distributed
+    sizes, covering about domain_fraction of the genome.
+    '''
+    domains = []
+    for chrom, size in chroms:
+        ndomains = max(1, int(size * domain_fraction / domain_size))
+        lengths = rs.exponential(domain_size, ndomains).astype(np.int64) + 1
+        lengths = np.minimum(lengths, size // (2 * ndomains))
+        # distribute the free space randomly between the domains
+        free = size - lengths.sum()
+        gaps = np.diff(np.sort(rs.randint(0, free, ndomains + 1)))
+        starts = np.cumsum(np.concatenate(([0], lengths[:-1]))) + np.cumsum(gaps)
+        domains.extend((chrom, int(s), int(s + l))
+                       for s, l in zip(starts, lengths))
+    return domains
+
+def sample_positions(rs, size, nreads, domains, enrichment, read_length):
+    '''
+    read start positions on a chromosome of the given size, where
+    positions within domains are enrichment times as likely.
+    '''
+    bounds = [0]
+    density = []
+    for start, end in domains:
+        bounds.extend((start, end))
+        density.extend((1.0, enrichment))
+    bounds.append(size - read_length)
+    density.append(1.0)
+    # reads must fit within the chromosome
+    bounds = np.minimum(bounds, size - read_length)
+    lengths = np.diff(bounds)
+    p = lengths * np.array(density)
+    segments = rs.choice(len(lengths), size=nreads, p=p / p.sum())
+    pos = bounds[segments] + (rs.random_sample(nreads) * lengths[segments]).astype(np.int64)
+    return np.sort(pos)
+
+def write_bam(path, chroms, positions, read_length):
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': chrom, 'LN': size} for chrom, size in chroms]}
+    a = pysam.AlignedSegment()
+    a.query_sequence = 'A' * read_length
+    a.query_qualities = pysam.qualitystring_to_array('I' * read_length)
+    a.flag = 0
+    a.mapping_quality = 60
+    a.cigar = ((0, read_length),)
+    i = 0
+    with pysam.AlignmentFile(path, 'wb', header=header) as f:
+        for tid, pos in enumerate(positions):
+            a.reference_id = tid
+            for p in pos:
+                a.query_name = 'r%d' % i
+                a.reference_start = int(p)
+                f.write(a)
+                i += 1
+    pysam.index(path)
+    return i
+
+def make_dataset(out_dir, genome_size=20000000, nchroms=4, coverage=0.5,
+                 read_length=50, domain_fraction=0.2, domain_size=500000,
+                 enrichment=2.0, unalignable_fraction=0.01, seed=0):
+    '''
+    writes a synthetic data set to out_dir. coverage is the read depth
+    of each bam file (reads * read_length / genome_size).
+    Returns a dict with the file paths and parameters.
+    '''
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    rs = np.random.RandomState(seed)
+    chroms = chrom_sizes(genome_size, nchroms)
+    domains = random_domains(rs, chroms, domain_fraction, domain_size)
+    res = {'genome_size': genome_size, 'nchroms': nchroms,
+           'coverage': coverage, 'read_length': read_length,
+           'domain_fraction': domain_fraction, 'domain_size': domain_size,
+           'enrichment': enrichment, 'seed': seed,
+           'ndomains': len(domains)}
+
+    res['chrom_sizes'] = os.path.join(out_dir, 'chrom.sizes')
+    with open(res['chrom_sizes'], 'w') as f:
+        for chrom, size in chroms:
+            f.write('%s\t%d\n' % (chrom, size))
+    res['domains'] = os.path.join(out_dir, 'domains.bed')
+    with open(res['domains'], 'w') as f:
+        for domain in domains:
+            f.write('%s\t%d\t%d\n' % domain)
+    # one centromere like region in the middle of each chromosome
+    res['unalignable_regions'] = os.path.join(out_dir, 'unalignable.bed')
+    with open(res['unalignable_regions'], 'w') as f:
+        for chrom, size in chroms:
+            half = int(size * unalignable_fraction / 2)
+            f.write('%s\t%d\t%d\n' % (chrom, size // 2 - half, size // 2 + half))
+
+    for name, enr in (('ip', enrichment), ('input', 1.0)):
+        positions = []
+        for chrom, size in chroms:
+            nreads = int(coverage * size / read_length)
+            chrom_domains = [(s, e) for c, s, e in domains if c == chrom]
+            positions.append(sample_positions(rs, size, nreads, chrom_domains,
+                                              enr, read_length))
+        res[name] = os.path.join(out_dir, name + '.bam')
+        res[name + '_reads'] = write_bam(res[name], chroms, positions, read_length)
+    with open(os.path.join(out_dir, 'dataset.json'), 'w') as f:
+        json.dump(res, f, indent=2, sort_keys=True)
+    return res
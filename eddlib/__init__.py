@@ -1,5 +1,7 @@
 
 from logbook import Logger
 
+__version__ = '1.1.19'
+
 log = Logger(__name__)
 
@@ -1,10 +1,11 @@
 from libc.stdlib cimport malloc, free, realloc
 cimport cython
 cimport numpy as np
+import numpy as np
 
 cdef class Segment:
-    cdef readonly int from_idx, to_idx
-    cdef readonly float score
+    cdef readonly Py_ssize_t from_idx, to_idx
+    cdef readonly double score
 
     def __init__(self, s, fi, ti):
         self.score = s
@@ -12,74 +13,223 @@ cdef class Segment:
         self.to_idx = ti
 
 
+# the maximal segments found by max_segments_batch, from_idx and
+# to_idx are indices into the genome wide scores
+segment_dtype = np.dtype([('segment', np.intp), ('score', np.float64),
+                          ('from_idx', np.intp), ('to_idx', np.intp)])
+
 cdef struct segment:
-    float I
-    float L
-    float R
-    int lidx
-    int ridx
-
-cdef int consider(segment *s, segment *buf, int k):
-    cdef int j = k - 1
-    while (j >= 0 and buf[j].L >= s.L):
-        j -= 1
-    if (j == -1 or buf[j].R >= s.R):
-        buf[k] = s[0]
-        return k + 1
-    else:
-        s.I = s.R - buf[j].L
-        s.L = buf[j].L
-        s.lidx = buf[j].lidx
-        s.ridx = s.ridx
-        return consider(s, buf, j)
+    # cumulative scores before the first and after the last bin
+    double L
+    double R
+    Py_ssize_t lidx
+    Py_ssize_t ridx
+    # the closest earlier segment with a lower L, or -1
+    Py_ssize_t prev
+
+cdef struct found_segment:
+    Py_ssize_t segment
+    double score
+    Py_ssize_t from_idx
+    Py_ssize_t to_idx
 
 cdef enum:
     N = 1000
 
-cdef int max_segments_impl(np.ndarray[np.float64_t] xs,
-                           segment **buf, int len_buf):
-    cdef float csum = 0
-    cdef int k = 0
-    cdef int i
-    cdef segment s
-    cdef float x, Lk, Rk
-    for i in range(len(xs)):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t count_positive(double *xs, Py_ssize_t n) nogil:
+    cdef Py_ssize_t i, k = 0
+    for i in range(n):
+        if xs[i] > 0:
+            k += 1
+    return k
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t segments_impl(double *xs, Py_ssize_t n, segment *buf) nogil:
+    '''
+    Ruzzo and Tompa's linear time algorithm for all maximal scoring
+    subsequences. The segments of xs are written to buf, which must
+    have room for one segment per positive score. Returns the number
+    of segments.
+    '''
+    cdef:
+      Py_ssize_t i, j, k = 0
+      double x, csum = 0
+      segment s
+    for i in range(n):
         x = xs[i]
-        Lk = csum
-        Rk = csum + x
-        csum += x;
-        if (k == len_buf):
-            len_buf *= 2
-            if (len_buf < N):
-                # if len_xs is initially zero
-              len_buf = N
-            buf[0] = <segment *> realloc(buf[0], len_buf * sizeof(segment))
-        if (x > 0):
-            s = segment(x, Lk, Rk, i, i)
-            k = consider(&s, buf[0], k)
+        s.L = csum
+        csum += x
+        s.R = csum
+        if not x > 0:
+            continue
+        s.lidx = s.ridx = i
+        j = k - 1
+        while True:
+            # the rightmost segment starting below s, segments between
+            # j and buf[j].prev start above buf[j] and are skipped
+            while j >= 0 and buf[j].L >= s.L:
+                j = buf[j].prev
+            if j == -1 or buf[j].R >= s.R:
+                break
+            # s is extended to the start of buf[j], which
+            # replaces buf[j] and all segments after it
+            s.L = buf[j].L
+            s.lidx = buf[j].lidx
+            k = j
+            j = buf[j].prev
+        s.prev = j
+        buf[k] = s
+        k += 1
     return k
 
 def max_segments(np.ndarray[np.float64_t] xs):
+    '''the maximal segments of xs as a list of Segment'''
+    segs = max_segments_batch(np.ascontiguousarray(xs),
+                              np.array([0, len(xs)], dtype=np.intp), 0, 1,
+                              -np.inf)
+    return [Segment(s, fi, ti) for s, fi, ti in zip(
+        segs['score'].tolist(), segs['from_idx'].tolist(),
+        segs['to_idx'].tolist())]
+
+def maximum_segment(np.ndarray[np.float64_t] xs):
+    '''score of the maximum segment of xs, or zero if there are no positive scores'''
+    return max_segment_scores(np.ascontiguousarray(xs).reshape(1, -1),
+                              np.array([0, len(xs)], dtype=np.intp))[0]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def max_segments_batch(double[::1] scores, Py_ssize_t[::1] bounds,
+                       Py_ssize_t first, Py_ssize_t last,
+                       double min_score=0):
+    '''
+    Maximal segments with a score above min_score of the segments
+    first, ..., last - 1 of scores, where segment c is found at
+    bounds[c]:bounds[c + 1]. Returns a structured array of
+    segment_dtype, ordered by segment and position.
+
+    The GIL is released, so several threads can each run a batch of
+    segments in parallel.
+    '''
     cdef:
       segment *buf = NULL
-      int buf_len, i
-    buf_len = max_segments_impl(xs, &buf, 0)
-    res = []
-    for i in range(buf_len):
-        y = Segment(buf[i].I, buf[i].lidx, buf[i].ridx)
-        res.append(y)
+      found_segment *found = NULL
+      found_segment *grown
+      Py_ssize_t c, i, j, k, n, npos, len_buf = 0, nfound = 0, len_found = 0
+      bint oom = False
+    assert 0 <= first <= last < bounds.shape[0]
+    assert bounds[bounds.shape[0] - 1] == scores.shape[0]
+    with nogil:
+        for c in range(first, last):
+            n = bounds[c + 1] - bounds[c]
+            if n == 0:
+                continue
+            npos = count_positive(&scores[bounds[c]], n)
+            if npos > len_buf:
+                free(buf)
+                len_buf = npos
+                buf = <segment *> malloc(len_buf * sizeof(segment))
+                if buf == NULL:
+                    oom = True
+                    break
+            k = segments_impl(&scores[bounds[c]], n, buf)
+            for j in range(k):
+                if buf[j].R - buf[j].L > min_score:
+                    if nfound == len_found:
+                        len_found = max(2 * len_found, N)
+                        grown = <found_segment *> realloc(
+                            found, len_found * sizeof(found_segment))
+                        if grown == NULL:
+                            oom = True
+                            break
+                        found = grown
+                    found[nfound].segment = c
+                    found[nfound].score = buf[j].R - buf[j].L
+                    found[nfound].from_idx = bounds[c] + buf[j].lidx
+                    found[nfound].to_idx = bounds[c] + buf[j].ridx
+                    nfound += 1
+            if oom:
+                break
     free(buf)
+    if oom:
+        free(found)
+        raise MemoryError()
+    res = np.empty(nfound, dtype=segment_dtype)
+    cdef Py_ssize_t[:] segs = res['segment'], from_idx = res['from_idx'], \
+        to_idx = res['to_idx']
+    cdef double[:] segment_scores = res['score']
+    for i in range(nfound):
+        segs[i] = found[i].segment
+        segment_scores[i] = found[i].score
+        from_idx[i] = found[i].from_idx
+        to_idx[i] = found[i].to_idx
+    free(found)
     return res
 
-def maximum_segment(np.ndarray[np.float64_t] xs):
-  cdef:
-    segment *buf = NULL
-    int i, buf_len
-    float cur_score, max_score = 0
-  buf_len = max_segments_impl(xs, &buf, 0)
-  for i in range(buf_len):
-    cur_score = buf[i].I
-    if cur_score > max_score:
-      max_score = cur_score
-  free(buf)
-  return max_score
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double max_scan(double *xs, Py_ssize_t n, double neg_scale) nogil:
+    '''
+    score of the maximum segment in xs, with negative scores multiplied
+    by neg_scale, or zero if there are no positive scores.
+    A single pass, no segment buffer needed.
+    '''
+    cdef Py_ssize_t i
+    cdef double x, cur = 0, best = 0
+    for i in range(n):
+        x = xs[i]
+        if x < 0:
+            x *= neg_scale
+        cur += x
+        if cur < 0:
+            cur = 0
+        elif cur > best:
+            best = cur
+    return best
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def max_segment_scores(double[:, ::1] perms, Py_ssize_t[::1] bounds,
+                       neg_scales=None):
+    '''
+    Maximum segment score for each row (e.g. a permutation of the
+    genome wide scores) of perms. Segments never span a chromosome
+    boundary, bounds holds the start offset of each chromosome
+    followed by the row length.
+
+    If neg_scales is given, each row is scored once per scale with
+    negative scores multiplied by the scale (see
+    GenomeBins.scale_neg_scores) and an array of shape
+    (rows, len(neg_scales)) is returned.
+
+    The GIL is released, so several threads can score batches in parallel.
+    '''
+    cdef:
+      Py_ssize_t t, c, k
+      Py_ssize_t ntrials = perms.shape[0]
+      Py_ssize_t nchroms = bounds.shape[0] - 1
+      double best, cur
+      double[::1] scales
+      double[:, ::1] res
+    assert bounds[nchroms] == perms.shape[1]
+    if neg_scales is None:
+        scales = np.ones(1)
+    else:
+        scales = np.ascontiguousarray(neg_scales, dtype=np.float64).reshape(-1)
+    res = np.zeros((ntrials, scales.shape[0]))
+    with nogil:
+        for t in range(ntrials):
+            for k in range(scales.shape[0]):
+                best = 0
+                for c in range(nchroms):
+                    if bounds[c + 1] > bounds[c]:
+                        cur = max_scan(&perms[t, bounds[c]],
+                                       bounds[c + 1] - bounds[c], scales[k])
+                        if cur > best:
+                            best = cur
+                res[t, k] = best
+    if neg_scales is None:
+        return np.asarray(res)[:, 0]
+    return np.asarray(res)
@@ -0,0 +1,69 @@
+'''
+Sorted interval index over genomic bins.
+
+Replaces bedtools intersect for counting the enriched and depleted
+bins within a set of intervals (e.g. potential peaks). Overlaps are
+found with np.searchsorted, so no temporary files or subprocesses
+are needed.
+'''
+import numpy as np
+
+
+class BinIndex(object):
+    '''
+    Non-overlapping bins per chromosome, sorted by start, with a
+    cumulative count of enriched (score > 0) bins.
+    '''
+
+    def __init__(self, chroms, starts, ends, scores):
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts)
+        ends = np.asarray(ends)
+        enriched = np.asarray(scores) > 0
+        self.starts = {}
+        self.ends = {}
+        self.enriched_csum = {}
+        for chrom in np.unique(chroms):
+            idx = np.flatnonzero(chroms == chrom)
+            idx = idx[np.argsort(starts[idx], kind='mergesort')]
+            self.starts[chrom] = starts[idx]
+            self.ends[chrom] = ends[idx]
+            cs = np.zeros(len(idx) + 1, dtype=np.int64)
+            np.cumsum(enriched[idx], out=cs[1:])
+            self.enriched_csum[chrom] = cs
+
+    @classmethod
+    def from_df(cls, df):
+        'df must have the columns chrom, start, end and score'
+        return cls(df.chrom.values, df.start.values, df.end.values,
+                   df.score.values)
+
+    def genome_wide_stats(self):
+        eib = sum(cs[-1] for cs in self.enriched_csum.values())
+        nbins = sum(len(xs) for xs in self.starts.values())
+        return {'EIB': int(eib), 'DIB': int(nbins - eib)}
+
+    def count_stats(self, chroms, starts, ends):
+        '''
+        counts enriched (EIB) and depleted (DIB) bins overlapping the
+        given intervals. A bin overlapping several intervals is counted
+        once per interval, like bedtools intersect.
+        '''
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts)
+        ends = np.asarray(ends)
+        stats = {'DIB': 0, 'EIB': 0}
+        for chrom in np.unique(chroms):
+            if not chrom in self.starts:
+                continue
+            m = chroms == chrom
+            # first bin ending after the interval start and
+            # first bin starting at or after the interval end
+            lo = np.searchsorted(self.ends[chrom], starts[m], side='right')
+            hi = np.searchsorted(self.starts[chrom], ends[m], side='left')
+            hi = np.maximum(hi, lo)
+            cs = self.enriched_csum[chrom]
+            eib = (cs[hi] - cs[lo]).sum()
+            stats['EIB'] += int(eib)
+            stats['DIB'] += int((hi - lo).sum() - eib)
+        return stats
@@ -1,76 +1,186 @@
 import operator
+import itertools
+import multiprocessing
 import numpy as np
 import collections
-import itertools
 from eddlib import util 
-from chrom_max_segments import max_segments
+from eddlib import executor
+from eddlib import tracks
+from chrom_max_segments import max_segments_batch
 import unalignable_regions
 import logbook
-from statsmodels.sandbox.stats.multicomp import multipletests
 
 log = logbook.Logger(__name__)
 
+# smaller inputs are not worth a thread
+min_bins_per_thread = 50000
+
 class GenomeBins(object):
     '''
-    Genome wide bins with scores.
+    Genome wide bins with scores, stored column wise.
+
+    The bins are divided into segments, where a segment may span a
+    complete chromosome or just a part (e.g. between two unalignable
+    regions). The bins of segment i are found at
+    offsets[i]:offsets[i + 1] in the start, end and score arrays.
     '''
 
-    def __init__(self, chrom_bins):
+    def __init__(self, names, chroms, offsets, starts, ends, scores):
         '''
         Keyword arguments:
-        chrom_bins -- dict of names->bins where a name may span a 
-                        complete chromosome or just a part
+        names -- segment names
+        chroms -- chromosome of each segment
+        offsets -- start offset of each segment, followed by the number of bins
+        starts, ends, scores -- genome wide bin arrays
         '''
-        self.chrom_bins = chrom_bins
-        self.chrom_scores = {k:np.array([x.score for x in v], dtype=float) 
-                for k, v in chrom_bins.items()}
+        self.names = list(names)
+        self.chroms = list(chroms)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.intp)
+        self.starts = np.asarray(starts)
+        self.ends = np.asarray(ends)
+        self.scores = np.ascontiguousarray(scores, dtype=float)
+        assert len(self.offsets) == len(self.names) + 1
+        assert self.offsets[-1] == len(self.scores)
+        # views, no copies
+        self.chrom_scores = {name: self.scores[self.offsets[i]:self.offsets[i + 1]]
+                             for i, name in enumerate(self.names)}
 
     @classmethod
-    def with_unalignable_regions_masked(cls, chrom_bins, unalignable_regions_file):
-        if unalignable_regions_file is not None:
-            g = unalignable_regions.read_file(unalignable_regions_file)
-            chrom_bins, _ = unalignable_regions.split_on_regions(chrom_bins, g)
-        return cls(chrom_bins)
-
-    def max_segments(self, filter_trivial=0):
-        def chrom_max(chrom):
-            xs = max_segments(self.chrom_scores[chrom])
-            bins = self.chrom_bins[chrom]
-            return [util.bed(bins[x.from_idx].chrom, bins[x.from_idx].start,
-                        bins[x.to_idx].end, x.score) for x in xs]
+    def from_arrays(cls, chrom_codes, chrom_names, starts, ends, scores):
+        '''
+        one segment per chromosome, with bins sorted by start.
+        chrom_codes holds the index into chrom_names of each bin.
+        '''
+        chrom_codes = np.asarray(chrom_codes)
+        starts = np.asarray(starts)
+        order = np.lexsort((starts, chrom_codes))
+        counts = np.bincount(chrom_codes, minlength=len(chrom_names))
+        names = [name for name, n in zip(chrom_names, counts) if n > 0]
+        offsets = np.concatenate(([0], np.cumsum(counts[counts > 0])))
+        return cls(names, names, offsets, starts[order],
+                   np.asarray(ends)[order], np.asarray(scores)[order])
+
+    def with_unalignable_regions_masked(self, unalignable_regions_file):
+        '''
+        new GenomeBins without bins overlapping an unalignable region.
+        Segments are split at each region, the parts of chromosome chrN
+        are named chrN_0, chrN_1, ...
+        '''
+        if unalignable_regions_file is None:
+            return self
+        regions = unalignable_regions.read_file(unalignable_regions_file)
+        names, chroms, lengths, keep = [], [], [], []
+        for i, name in enumerate(self.names):
+            chrom = self.chroms[i]
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            if not chrom in regions.starts:
+                names.append(name)
+                chroms.append(chrom)
+                lengths.append(hi - lo)
+                keep.append(np.arange(lo, hi))
+                continue
+            idx, run_ids = regions.split_runs(chrom, self.starts[lo:hi],
+                                              self.ends[lo:hi])
+            run_lengths = np.bincount(run_ids) if len(run_ids) else []
+            names.extend('%s_%d' % (name, j) for j in range(len(run_lengths)))
+            chroms.extend([chrom] * len(run_lengths))
+            lengths.extend(run_lengths)
+            keep.append(lo + idx)
+        keep = np.concatenate(keep) if keep else np.array([], dtype=np.intp)
+        return GenomeBins(names, chroms, np.concatenate(([0], np.cumsum(lengths))),
+                          self.starts[keep], self.ends[keep], self.scores[keep])
+
+    def segment_array(self, filter_trivial=0, nthreads=None):
+        '''
+        the maximal segments with a score above filter_trivial as a
+        structured array (see chrom_max_segments.segment_dtype), with
+        from_idx and to_idx indexing the genome wide bin arrays.
+
+        The segments are divided into nthreads batches of about the
+        same number of bins (default: one per cpu), which are run in
+        parallel on executor.threads (inline if the executor is serial).
+        '''
+        if nthreads is None:
+            nthreads = multiprocessing.cpu_count()
+        nthreads = int(max(1, min(nthreads, len(self.scores) // min_bins_per_thread)))
+        # the first segment of each batch
+        cuts = np.searchsorted(self.offsets, np.linspace(0, len(self.scores),
+                                                         nthreads + 1))
+        cuts[0], cuts[-1] = 0, len(self.names)
+        batches = [(lo, hi) for lo, hi in zip(cuts[:-1], cuts[1:]) if hi > lo]
+
+        def run(batch):
+            return max_segments_batch(self.scores, self.offsets, batch[0],
+                                      batch[1], filter_trivial)
+        if len(batches) <= 1:
+            return run((0, len(self.names)))
+        return np.concatenate(executor.threads().map(run, batches))
+
+    def max_segments(self, filter_trivial=0, nthreads=None):
+        '''
+        the maximal segments with a score above filter_trivial as
+        util.bed tuples, in a dict of chrom -> segments sorted by start.
+        '''
+        segs = self.segment_array(filter_trivial, nthreads)
+        chrom_names, chrom_codes = np.unique(self.chroms, return_inverse=True)
+        codes = chrom_codes[segs['segment']]
+        starts = self.starts[segs['from_idx']]
+        order = np.lexsort((starts, codes))
+        codes, starts = codes[order], starts[order]
+        ends = self.ends[segs['to_idx'][order]]
+        scores = segs['score'][order]
+        bounds = np.searchsorted(codes, np.arange(len(chrom_names) + 1))
         segments_per_chrom = collections.defaultdict(list)
-        for x in itertools.chain.from_iterable(chrom_max(k) for k in self.chrom_bins):
-            if x.score > filter_trivial:
-                segments_per_chrom[x.chrom].append(x)
-        num_intervals = 0
-        for xs in segments_per_chrom.values():
-            xs.sort(key=operator.attrgetter('start'))
-            num_intervals += len(xs)
+        for code, chrom in enumerate(chrom_names.tolist()):
+            lo, hi = bounds[code], bounds[code + 1]
+            if hi > lo:
+                segments_per_chrom[chrom] = map(
+                    util.bed, itertools.repeat(chrom, hi - lo),
+                    starts[lo:hi].tolist(), ends[lo:hi].tolist(),
+                    scores[lo:hi].tolist())
         if filter_trivial > 0:
             log.notice('Removed trivial intervals with score less than %.4f.' % filter_trivial)
-            log.notice('%d intervals (potential peaks) remaining.' % num_intervals)
+            log.notice('%d intervals (potential peaks) remaining.' % len(segs))
         return segments_per_chrom
 
     @classmethod
     def df_as_bins(cls, df, gap_file):
         '''
         converts a already scored df to an object
-        containing a dict of bins per chromosome, separated by gaps.
+        containing the bins per chromosome, separated by gaps.
         '''
-        chromd = collections.defaultdict(list)
-        for _, x in df.iterrows():
-            b = util.bed(x['chrom'], x['start'], x['end'],
-                    x['score'])
-            chromd[b.chrom].append(b)
-        return cls.with_unalignable_regions_masked(chromd, gap_file)
+        chrom_codes, chrom_names = df.chrom.factorize(sort=True)
+        gb = cls.from_arrays(chrom_codes, chrom_names, df.start.values,
+                             df.end.values, df.score.values)
+        return gb.with_unalignable_regions_masked(gap_file)
 
     def scale_neg_scores(self, scale):
-        return GenomeBins(
-            {k:[util.bed(x.chrom, x.start, x.end,
-                         x.score if x.score > 0 else x.score * scale)
-                for x in xs]
-             for k, xs in self.chrom_bins.items()})
-    
+        '''new GenomeBins with negative scores multiplied by scale'''
+        return GenomeBins(self.names, self.chroms, self.offsets,
+                          self.starts, self.ends,
+                          np.where(self.scores > 0, self.scores,
+                                   self.scores * scale))
+
+
+def segments_as_arrays(segments_per_chrom):
+    '''the segments returned by GenomeBins.max_segments as arrays'''
+    xs = [x for chrom in sorted(segments_per_chrom)
+          for x in segments_per_chrom[chrom]]
+    return {'chroms': np.array([x.chrom for x in xs], dtype=str),
+            'starts': np.array([x.start for x in xs], dtype=np.int64),
+            'ends': np.array([x.end for x in xs], dtype=np.int64),
+            'scores': np.array([x.score for x in xs], dtype=np.float64)}
+
+def segments_from_arrays(chroms, starts, ends, scores):
+    '''reverses segments_as_arrays'''
+    segments_per_chrom = collections.defaultdict(list)
+    for x in itertools.imap(util.bed, np.asarray(chroms).tolist(),
+                            np.asarray(starts).tolist(),
+                            np.asarray(ends).tolist(),
+                            np.asarray(scores).tolist()):
+        segments_per_chrom[x.chrom].append(x)
+    return segments_per_chrom
+
 
 class IntervalTest(object):
 
@@ -80,12 +190,16 @@ class IntervalTest(object):
         self._pvalues = None
         self._pvalues = None
 
+    @staticmethod
+    def score_pvalues(scores, sorted_mc_res):
+        '''empirical p-values of segment scores given the sorted monte carlo scores'''
+        pos = len(sorted_mc_res) - np.searchsorted(sorted_mc_res, scores)
+        return (pos + 1) / float(len(sorted_mc_res) + 1)
+
     def pvalues(self):
         res = []
         for xs in self.max_intervals.values():
-            pos = len(self.mc_res) - np.searchsorted(self.mc_res,
-                    [x.score for x in xs])
-            pvals = (pos + 1) / float(len(self.mc_res) + 1)
+            pvals = self.score_pvalues([x.score for x in xs], self.mc_res)
             for x, pval in zip(xs, pvals):
                 res.append((x, pval))
         self._pvalues = res
@@ -95,7 +209,7 @@ class IntervalTest(object):
         if not self._pvalues:
             self.pvalues()
         pvals = [x[1] for x in self._pvalues]
-        qvals = list(multipletests(pvals, method='fdr_bh')[1])
+        qvals = list(util.fdr_bh(pvals))
         res = [(q,p,x) for (q, (x,p)) in zip(qvals, self._pvalues)
             if q < below]
         self._qvalues = res
@@ -105,11 +219,13 @@ class IntervalTest(object):
 
     @classmethod
     def segments_to_bedstream(cls, segments, bedstream):
-        for segment in segments:
-            bedstream.write('\t'.join((segment.chrom, str(segment.start),
-                                str(segment.end),
-                                str(segment.score))))
-            bedstream.write('\n')
+        chroms = [x.chrom for x in segments]
+        codes, names = tracks.chrom_codes(chroms)
+        tracks.write_bed(bedstream, names, codes,
+                         np.array([x.start for x in segments], dtype=np.int64),
+                         np.array([x.end for x in segments], dtype=np.int64),
+                         [np.array([x.score for x in segments], dtype=np.float64)],
+                         value_format=lambda xs: map(str, xs.tolist()))
 
     def as_bed(self, output_file):
         if self._qvalues is None:
@@ -1,8 +1,23 @@
 import numpy as np
-from chrom_max_segments import maximum_segment
+from chrom_max_segments import max_segment_scores
 from bisect import bisect_left
-import multiprocessing
-from statsmodels.sandbox.stats.multicomp import multipletests
+from scipy.special import btdtri
+import logbook
+from eddlib.sharedmem import SharedArray
+from eddlib import executor
+from eddlib import util
+
+log = logbook.Logger(__name__)
+
+def trial_seeds(seed, ntrials):
+    '''
+    one seed per trial, derived from seed. Trial i always shuffles with
+    the i-th seed, so results only depend on seed and not on how the
+    trials are divided between processes. A random seed is used if
+    seed is None.
+    '''
+    return np.random.RandomState(seed).randint(0, 2**32 - 1, size=ntrials,
+                                               dtype=np.int64)
 
 class MonteCarlo(object):
     """
@@ -12,47 +27,197 @@ class MonteCarlo(object):
     Shuffles across chromosomes 
     """
 
+    # memory used for a batch of permutations scored in one kernel call
+    batch_bytes = 64 * 2**20
+
     def __init__(self, observed_data):
         """
         Arguments:
         - `observed_data`: {<chrom-name>: array of scores}
         """
 
-        self.names = observed_data.keys()
-        self.chrom_lengths = [len(x) for x in observed_data.values()]
-        self._mc_arr = np.concatenate(observed_data.values())
+        # sorted, so the permutations of a seed do not depend on dict order
+        names = sorted(observed_data)
+        self.__set_scores(names, [len(observed_data[x]) for x in names],
+                          np.concatenate([observed_data[x] for x in names]))
+
+    @classmethod
+    def from_array(cls, scores, names, chrom_lengths):
+        '''
+        from scores already concatenated in the order of names,
+        without splitting them per chromosome.
+        '''
+        mc = cls.__new__(cls)
+        mc.__set_scores(names, chrom_lengths, scores)
+        return mc
 
-    def __generate_permutation(self):
-        a = self._mc_arr#.copy()
-        np.random.shuffle(a)
-        # last interval is implicitly known (rest of array), so it's left out
-        split_idx = np.cumsum(self.chrom_lengths[:-1])
-        xs = np.split(a, split_idx)
-        return dict(zip(self.names, xs))
+    def __set_scores(self, names, chrom_lengths, scores):
+        self.names = list(names)
+        self.chrom_lengths = list(chrom_lengths)
+        # a private copy, trials shuffle copies of it
+        self._mc_arr = np.array(scores, dtype=np.float64)
+        # start offset of each chromosome in _mc_arr, followed by its length
+        self.bounds = np.concatenate(([0], np.cumsum(self.chrom_lengths))).astype(np.intp)
 
     def trial(self):
         'Runs a trial and returns the score of the maximum segment'
-        p = self.__generate_permutation()
-        return max(maximum_segment(xs) for xs in p.values())
-        
-    def __call__(self, i):
-        '''same as self.trial(), but prints a "." to stderr when done to
-        indicate progress...'''
-        np.random.seed()
-        res = self.trial()
+        return self.run_trials(1)[0]
+
+    def run_trials(self, ntrials, neg_scales=None, seeds=None):
+        '''
+        Runs ntrials trials and returns an array with the maximum segment scores.
+        Permutations are generated in batches, and each batch is scored
+        by a single call to max_segment_scores.
+
+        If neg_scales is given, each permutation is scored once per scale
+        of the negative scores and an array of shape (ntrials, len(neg_scales))
+        is returned. If seeds is given, trial i shuffles with seeds[i],
+        so the same permutations can be repeated (common random numbers).
+        '''
+        if neg_scales is None:
+            res = np.empty(ntrials)
+        else:
+            res = np.empty((ntrials, len(neg_scales)))
+        batch = max(1, min(ntrials, self.batch_bytes // (8 * max(1, len(self._mc_arr)))))
+        perms = np.empty((batch, len(self._mc_arr)))
+        for first in range(0, ntrials, batch):
+            n = min(batch, ntrials - first)
+            for i, row in enumerate(perms[:n]):
+                row[:] = self._mc_arr
+                if seeds is None:
+                    np.random.shuffle(row)
+                else:
+                    np.random.RandomState(seeds[first + i]).shuffle(row)
+            res[first:first + n] = max_segment_scores(perms[:n], self.bounds,
+                                                      neg_scales)
         return res
-    workers = None 
+
+    trial_blocks_per_proc = 4
+
     @classmethod
-    def run_simulation(cls, observed_data, niter=4, nprocs=4):
+    def run_simulation(cls, observed_data, niter=4, nprocs=4,
+                       stop_rule=None, round_size=500,
+                       neg_scales=None, seeds=None, seed=None):
+        '''
+        Runs niter trials and returns the sorted maximum segment scores.
+        See run_trials for neg_scales and seeds, with neg_scales the
+        result holds one sorted column per scale. Unless seeds is
+        given, the trial seeds are derived from seed (see trial_seeds),
+        so the result of a given seed is the same for any nprocs.
+
+        If stop_rule is given, trials are run in rounds of round_size and
+        stop_rule(maximum scores so far) is asked after each round whether
+        the simulation can stop early. niter is then the maximum number
+        of trials.
+        '''
+        assert stop_rule is None or neg_scales is None
+        assert seeds is None or len(seeds) == niter
+        if seeds is None:
+            seeds = trial_seeds(seed, niter)
         mc = cls(observed_data)
-        if nprocs > 1:
-            if cls.workers is None:
-                cls.workers = multiprocessing.Pool(nprocs)
-                # async makes keyboard interrupt work
-            xs = cls.workers.map_async(mc, range(niter)).get(99999999)
-        else:
-            xs = [mc(i) for i in range(niter)]
-        return np.sort(xs)
+        ex = executor.get(nprocs)
+        shared = None
+        if ex.kind == 'process':
+            # the scores are placed in shared memory once per simulation
+            # and each task runs a block of trials, so only the
+            # maximum scores are sent back from the workers.
+            shared = SharedArray.from_array(mc._mc_arr)
+        try:
+            res = []
+            ndone = 0
+            while ndone < niter:
+                n = niter - ndone
+                if stop_rule is not None:
+                    n = min(n, round_size)
+                round_seeds = seeds[ndone:ndone + n]
+                if ex.kind == 'serial':
+                    res.append(mc.run_trials(n, neg_scales, round_seeds))
+                else:
+                    res.append(cls.__run_blocks(ex, mc, shared, n,
+                                                neg_scales, round_seeds))
+                ndone += n
+                if stop_rule is not None and ndone < niter and \
+                   stop_rule(np.concatenate(res)):
+                    log.notice('stopped monte carlo simulation early after %d of %d trials' % (
+                        ndone, niter))
+                    break
+        finally:
+            if shared is not None:
+                shared.unlink()
+        return np.sort(np.concatenate(res), axis=0)
+
+    @classmethod
+    def __run_blocks(cls, ex, mc, shared, ntrials, neg_scales, seeds):
+        nblocks = min(ntrials, ex.nworkers * cls.trial_blocks_per_proc)
+        blocks = np.array_split(np.arange(ntrials), nblocks)
+        if shared is None:
+            # threads share mc, the kernel runs without the GIL
+            f = lambda xs: mc.run_trials(len(xs), neg_scales,
+                                         seeds[xs[0]:xs[-1] + 1])
+            return np.concatenate(ex.map(f, blocks))
+        blocks = [(shared, mc.names, mc.chrom_lengths, len(xs), neg_scales,
+                   seeds[xs[0]:xs[-1] + 1]) for xs in blocks]
+        return np.concatenate(ex.map(run_trial_block, blocks))
+
+
+class FdrDecisionRule(object):
+    '''
+    Stopping rule for MonteCarlo.run_simulation.
+
+    The simulation may stop once the significance of every observed
+    segment score at the given fdr is settled. For each score, a
+    Clopper-Pearson interval (at the given confidence) for its true
+    p-value is computed from the number of trials with a maximum at
+    least as large. Stopping requires the Benjamini-Hochberg decisions
+    to be identical for the lower interval bounds, the upper interval
+    bounds and the p-values as computed by IntervalTest. As BH is
+    monotone in the p-values, more trials are then unlikely to change
+    any decision.
+    '''
+
+    def __init__(self, observed_scores, fdr, confidence=0.999, min_trials=500):
+        self.observed_scores = np.asarray(observed_scores, dtype=float)
+        self.fdr = fdr
+        self.alpha = 1 - confidence
+        self.min_trials = min_trials
+
+    def decisions(self, pvals):
+        return util.fdr_bh(pvals) < self.fdr
+
+    def __call__(self, mc_res):
+        n = len(mc_res)
+        if n < self.min_trials:
+            return False
+        if len(self.observed_scores) == 0:
+            return True
+        mc_res = np.sort(mc_res)
+        k = n - np.searchsorted(mc_res, self.observed_scores)
+        pvals = (k + 1) / float(n + 1)
+        with np.errstate(invalid='ignore'):
+            p_low = np.nan_to_num(beta_ppf(self.alpha / 2, k, n - k + 1))
+            p_high = beta_ppf(1 - self.alpha / 2, k + 1, n - k)
+        p_high[k == n] = 1.0
+        res = self.decisions(pvals)
+        return ((res == self.decisions(p_low)).all() and
+                (res == self.decisions(p_high)).all())
+
+
+def beta_ppf(q, a, b):
+    '''scipy.stats.beta.ppf for 0 < q < 1, nan where a or b is not positive'''
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    return np.where((a > 0) & (b > 0), btdtri(a, b, q), np.nan)
+
+def run_trial_block(args):
+    '''
+    worker side of MonteCarlo.run_simulation. args is a tuple of
+    (shared scores, chrom names, chrom lengths, number of trials,
+    neg_scales, seeds). run_simulation always gives the trial seeds, so
+    the results do not depend on the random state of the worker.
+    '''
+    shared, names, chrom_lengths, ntrials, neg_scales, seeds = args
+    assert seeds is not None and len(seeds) == ntrials
+    mc = MonteCarlo.from_array(shared.arr, names, chrom_lengths)
+    return mc.run_trials(ntrials, neg_scales, seeds)
 
 
 def fdr_qvals(obs, mc):
@@ -68,6 +233,6 @@ def fdr_qvals(obs, mc):
     obs = np.sort(obs)[::-1]
     mc = np.sort(mc)
     pvals = list(compute_pvalues(obs, mc))
-    qvals = list(multipletests(pvals, method='fdr_bh')[1])
+    qvals = list(util.fdr_bh(pvals))
     return dict(pvals=pvals, qvals=qvals)
 
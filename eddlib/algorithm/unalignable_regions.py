@@ -1,90 +1,92 @@
-import collections
-import operator
 import os
+import numpy as np
 import logbook
-import pybedtools
 
 
 log = logbook.Logger(__name__)
 
 class UnalignableRegions(object):
+    '''
+    Sorted and merged (overlapping or book-ended) regions per chromosome,
+    stored as start and end arrays.
+    '''
 
-    def __init__(self, chrom, start, end):
-        self.chrom = chrom
-        self.start = start
-        self.end = end
+    def __init__(self, chroms, starts, ends):
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        self.starts = {}
+        self.ends = {}
+        for chrom in np.unique(chroms):
+            m = chroms == chrom
+            self.starts[chrom], self.ends[chrom] = self.merge(starts[m], ends[m])
 
-    def bigger_than(self, x):
-        '''
-        returns true if gap comes after param x (no overlap)
-        '''
-        return x.end <= self.start
+    @staticmethod
+    def merge(starts, ends):
+        order = np.argsort(starts, kind='mergesort')
+        starts, ends = starts[order], ends[order]
+        # a region starts a new merged region if it starts after
+        # all previous regions have ended
+        prev_end = np.maximum.accumulate(ends)
+        new = np.ones(len(starts), dtype=bool)
+        new[1:] = starts[1:] > prev_end[:-1]
+        group_ends = np.append(np.flatnonzero(new)[1:] - 1, len(starts) - 1)
+        return starts[new], prev_end[group_ends]
+
+    def __len__(self):
+        return sum(len(xs) for xs in self.starts.values())
+
+    def coverage(self):
+        return sum((self.ends[c] - self.starts[c]).sum() for c in self.starts)
 
-    def overlaps(self, x):
+    def split_runs(self, chrom, starts, ends):
         '''
-        returns true if the two intervals overlaps
+        Finds the bins (sorted by start) not overlapping any region.
+        Returns the indices of these bins and a run id per index,
+        where consecutive bins with no region in between share a run.
         '''
-        return (self.start <= x.start < self.end or
-                self.start < x.end <= self.end)
+        if not chrom in self.starts:
+            return np.arange(len(starts)), np.zeros(len(starts), dtype=np.intp)
+        region_starts = self.starts[chrom]
+        region_ends = self.ends[chrom]
+        # the first region ending after the bin start
+        ridx = np.searchsorted(region_ends, starts, side='right')
+        masked = np.zeros(len(starts), dtype=bool)
+        within = ridx < len(region_starts)
+        masked[within] = region_starts[ridx[within]] < ends[within]
+        keep = np.flatnonzero(~masked)
+        # a new run starts after masked bins or when a region
+        # lies between two kept bins
+        new_run = np.ones(len(keep), dtype=bool)
+        new_run[1:] = np.logical_or(np.diff(keep) > 1, np.diff(ridx[keep]) > 0)
+        return keep, np.cumsum(new_run) - 1
 
-    def __repr__(self):
-        return 'UnalignableRegions(%s, %d, %d)' % (self.chrom, self.start, self.end)
+
+_regions_cache = {}
 
 def read_file(path):
-    res = []
-    if os.stat(path).st_size > 0:
-        for e in pybedtools.BedTool(path).sort().merge():
-            x = UnalignableRegions(e.chrom, e.start, e.end)
-            res.append(x)
+    '''
+    Reads and merges the regions of a bed file. The result is cached,
+    so the file is only parsed once as long as it is unchanged.
+    '''
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    if key in _regions_cache:
+        return _regions_cache[key]
+    chroms, starts, ends = [], [], []
+    if st.st_size > 0:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                    continue
+                xs = line.split()
+                chroms.append(xs[0])
+                starts.append(int(xs[1]))
+                ends.append(int(xs[2]))
     else:
         log.notice('unalignable regions file is empty, skipping.')
-    tot = sum(x.end - x.start for x in res)
+    res = UnalignableRegions(chroms, starts, ends)
     log.notice('Unalignable regions file read. Got %d regions. Total coverage: %.2fMB' % (
-        len(res) ,tot / 1e6))
+        len(res), res.coverage() / 1e6))
+    _regions_cache[key] = res
     return res
-
-def split_on_regions(scores_per_chrom, regions):
-    dg = collections.defaultdict(list)
-    revdict = {}
-    d = {}
-    for g in regions:
-        dg[g.chrom].append(g)
-
-    for chrom, regions in dg.items():
-        if not chrom in scores_per_chrom:
-            continue
-        regions.sort(key=operator.attrgetter('start'))
-        groups = []
-        cur_grp = []
-        cur_gap = 0
-        ndropped = 0
-        bins = iter(scores_per_chrom[chrom])
-        try:
-            while True:
-                x = bins.next()
-                if regions[cur_gap].bigger_than(x):
-                    cur_grp.append(x)
-                elif regions[cur_gap].overlaps(x):
-                    if len(cur_grp) > 0:
-                        groups.append(cur_grp)
-                        cur_grp = []
-                    ndropped += 1
-                else:
-                    cur_gap += 1
-                    if len(regions) == cur_gap:
-                        cur_grp.append(x)
-                        cur_grp.extend(bins)
-                        break
-                    if not regions[cur_gap].overlaps(x):
-                        cur_grp.append(x)
-        except StopIteration:
-            pass
-        if len(cur_grp) > 0:
-            groups.append(cur_grp)
-        names = ['%s_%d' % (chrom, i) for i in range(len(groups))]
-        d.update(zip(names, groups))
-        for name in names:
-            revdict[name] = chrom
-    for chrom in (scores_per_chrom.viewkeys() - dg.viewkeys()):
-        d[chrom] = scores_per_chrom[chrom]
-    return d, revdict
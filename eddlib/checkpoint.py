@@ -0,0 +1,138 @@
+'''
+Resumable pipeline stages.
+
+The output of each stage (bin counts, bin scores, gap penalty, observed
+segments and the monte carlo null) is saved in the output directory,
+keyed by a hash of everything it depends on: the input files, the
+parameters of the stage and the key of the stage before it. A rerun
+loads every stage whose key is unchanged and recomputes from the first
+stage that is not, e.g. a changed --fdr only reruns the thresholding.
+
+Each entry is a directory named <stage>-<key> holding a manifest.json
+and one .npy file per array. Only the latest entry of a stage is kept.
+'''
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pa
+from logbook import Logger
+
+log = Logger(__name__)
+
+
+class Checkpoints(object):
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self, directory, enabled=True):
+        '''if not enabled, nothing is loaded or saved'''
+        self.directory = directory
+        self.enabled = enabled
+        self.resumed = []
+
+    def key(self, stage, parent, **params):
+        '''
+        the key of a stage, given the key of the stage it depends on
+        (or None) and its json serializable parameters.
+        '''
+        d = {'stage': stage, 'parent': parent, 'params': params}
+        return hashlib.sha1(json.dumps(d, sort_keys=True)).hexdigest()
+
+    def entry_dir(self, stage, key):
+        return os.path.join(self.directory, '%s-%s' % (stage, key[:16]))
+
+    def load(self, stage, key):
+        '''
+        returns the saved entry of a stage, or None. An entry is a dict
+        of its info and arrays (memory-mapped).
+        '''
+        if not self.enabled:
+            return None
+        entry_dir = self.entry_dir(stage, key)
+        manifest_path = os.path.join(entry_dir, self.manifest_name)
+        if not os.path.isfile(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['key'] != key:
+            return None
+        entry = {name: np.load(os.path.join(entry_dir, fname), mmap_mode='r')
+                 for name, fname in manifest['arrays'].items()}
+        entry['info'] = manifest['info']
+        self.resumed.append(stage)
+        log.notice('resuming stage %s from %s' % (stage, entry_dir))
+        return entry
+
+    def save(self, stage, key, info=None, **arrays):
+        if not self.enabled:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # written to a temporary directory first, so an interrupted
+        # run never leaves a partially written entry.
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            manifest = {'stage': stage, 'key': key, 'info': info or {},
+                        'arrays': {}}
+            for i, name in enumerate(sorted(arrays)):
+                fname = 'array_%d.npy' % i
+                np.save(os.path.join(tmp_dir, fname), np.asarray(arrays[name]))
+                manifest['arrays'][name] = fname
+            with open(os.path.join(tmp_dir, self.manifest_name), 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            self.__remove_stage(stage)
+            os.rename(tmp_dir, self.entry_dir(stage, key))
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+    def saved_seed(self):
+        '''the random seed of the checkpointed run, or None'''
+        if not os.path.isdir(self.directory):
+            return None
+        for name in sorted(os.listdir(self.directory)):
+            manifest_path = os.path.join(self.directory, name, self.manifest_name)
+            if os.path.isfile(manifest_path):
+                with open(manifest_path) as f:
+                    seed = json.load(f)['info'].get('seed')
+                if seed is not None:
+                    return seed
+        return None
+
+    def __remove_stage(self, stage):
+        for name in os.listdir(self.directory):
+            if name.startswith(stage + '-'):
+                shutil.rmtree(os.path.join(self.directory, name))
+
+    @staticmethod
+    def df_as_arrays(df):
+        '''columns of a data frame as arrays, categorical columns as codes'''
+        arrays = {}
+        for col in df.columns:
+            if hasattr(df[col], 'cat'):
+                arrays['cat_codes:' + col] = df[col].cat.codes.values
+                arrays['cat_names:' + col] = np.array(
+                    [str(x) for x in df[col].cat.categories])
+            elif df[col].dtype == object:
+                arrays['col:' + col] = df[col].values.astype(str)
+            else:
+                arrays['col:' + col] = df[col].values
+        arrays['columns'] = np.array(list(df.columns))
+        return arrays
+
+    @staticmethod
+    def df_from_arrays(entry):
+        '''reverses df_as_arrays, the arrays are copied to memory'''
+        d = {}
+        for col in entry['columns']:
+            col = str(col)
+            if 'col:' + col in entry:
+                d[col] = np.array(entry['col:' + col])
+            else:
+                d[col] = pa.Categorical.from_codes(
+                    np.array(entry['cat_codes:' + col]),
+                    [str(x) for x in entry['cat_names:' + col]])
+        return pa.DataFrame(d, columns=[str(x) for x in entry['columns']])
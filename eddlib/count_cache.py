@@ -0,0 +1,102 @@
+'''
+On-disk store of binned read counts.
+
+Each entry is a directory holding one .npy file per chromosome and a
+manifest.json. Entries are keyed by the identity of the bam file
+(path, size, mtime and the same for its index), the bin size and a
+hash of the chromosome sizes, so a changed bam file or chrom sizes
+file is never served from the cache. Counts are loaded memory-mapped.
+'''
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from logbook import Logger
+
+log = Logger(__name__)
+
+
+def file_identity(path):
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size,
+            'mtime': st.st_mtime}
+
+def bam_identity(bam_path):
+    d = file_identity(bam_path)
+    for idx_path in (bam_path + '.bai', os.path.splitext(bam_path)[0] + '.bai'):
+        if os.path.isfile(idx_path):
+            d['index'] = file_identity(idx_path)
+            break
+    else:
+        d['index'] = None
+    return d
+
+def chromsizes_hash(chromsizes):
+    h = hashlib.sha1()
+    for chrom in sorted(chromsizes):
+        h.update('%s\t%d\n' % (chrom, chromsizes[chrom]))
+    return h.hexdigest()
+
+
+class CountCache(object):
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self, cache_dir, chromsizes, bin_size):
+        self.cache_dir = cache_dir
+        self.chromsizes = chromsizes
+        self.bin_size = bin_size
+        self.chromsizes_hash = chromsizes_hash(chromsizes)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, bam_path):
+        d = {'bam': bam_identity(bam_path),
+             'bin_size': self.bin_size,
+             'chromsizes': self.chromsizes_hash}
+        return hashlib.sha1(json.dumps(d, sort_keys=True)).hexdigest(), d
+
+    def get(self, bam_path):
+        '''
+        returns a dict of chrom -> memory-mapped counts, or None if
+        the bam file has not been counted with these settings.
+        '''
+        key, _ = self.key(bam_path)
+        entry_dir = os.path.join(self.cache_dir, key)
+        manifest_path = os.path.join(entry_dir, self.manifest_name)
+        if not os.path.isfile(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        log.notice('using cached bin counts for %s' % bam_path)
+        return {chrom: np.load(os.path.join(entry_dir, fname), mmap_mode='r')
+                for chrom, fname in manifest['chroms'].items()}
+
+    def put(self, bam_path, chrom_bins):
+        key, identity = self.key(bam_path)
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir):
+            return
+        # written to a temporary directory first, so concurrent
+        # runs never see a partially written entry.
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        try:
+            manifest = dict(identity, chroms={})
+            for i, chrom in enumerate(sorted(chrom_bins)):
+                fname = 'chrom_%d.npy' % i
+                np.save(os.path.join(tmp_dir, fname),
+                        np.asarray(chrom_bins[chrom], dtype=np.float64))
+                manifest['chroms'][chrom] = fname
+            with open(os.path.join(tmp_dir, self.manifest_name), 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.rename(tmp_dir, entry_dir)
+            log.notice('saved bin counts for %s to cache' % bam_path)
+        except OSError:
+            # another process stored the same entry first
+            if not os.path.isdir(entry_dir):
+                raise
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
@@ -0,0 +1,101 @@
+'''
+Reads and writes precomputed bin counts, so EDD can start from
+counts made upstream instead of bam files.
+
+Two formats are supported:
+
+* A tab separated text file (optionally gzipped) with one bin per line.
+  Either with a header line naming the columns chrom, start, end, ip
+  and input (other columns are ignored), or without a header and the
+  columns chrom, start, end, ip, input. Six columns without a header
+  are read as chrom, start, end, log_ratio, ip, input, which is the
+  output of edd-tools log-ratio --save-counts.
+* A NumPy archive (.npz) as written by write_npz.
+
+All bins must have the same size, except a shorter last bin of a
+chromosome. Missing bins are counted as zero.
+'''
+import numpy as np
+import pandas as pa
+from logbook import Logger
+from read_bam import nbins_for_chrom
+
+log = Logger(__name__)
+
+text_columns = {5: ['chrom', 'start', 'end', 'ip', 'input'],
+                6: ['chrom', 'start', 'end', 'log_ratio', 'ip', 'input']}
+
+
+def read_count_table(path, chromsizes):
+    '''
+    returns bin_size and dicts of chrom -> ip counts and
+    chrom -> input counts for the chromosomes in chromsizes.
+    '''
+    if path.endswith('.npz'):
+        return read_npz(path, chromsizes)
+    return read_text(path, chromsizes)
+
+def read_text(path, chromsizes):
+    first = pa.read_csv(path, sep='\t', header=None, nrows=1, comment='#')
+    names = [str(x) for x in first.iloc[0]]
+    if 'ip' in names and 'input' in names:
+        header, names = 0, None
+    else:
+        assert len(names) in text_columns, \
+            'count table %s must have 5 or 6 columns, found %d' % (path, len(names))
+        header, names = None, text_columns[len(names)]
+    df = pa.read_csv(path, sep='\t', header=header, names=names, comment='#',
+                     usecols=['chrom', 'start', 'end', 'ip', 'input'],
+                     dtype={'chrom': 'category', 'start': np.int64,
+                            'end': np.int64, 'ip': np.float64,
+                            'input': np.float64})
+    assert len(df) > 0, 'count table %s is empty' % path
+    lengths = df.end.values - df.start.values
+    bin_size = int(lengths.max())
+    assert bin_size > 0 and (df.start.values % bin_size == 0).all(), \
+        'the bins of count table %s are not of a fixed size' % path
+    ipd, inputd = {}, {}
+    codes = df.chrom.cat.codes.values
+    for code, chrom in enumerate(df.chrom.cat.categories):
+        chrom = str(chrom)
+        if not chrom in chromsizes:
+            log.warn('skipping chrom %s of count table, not in chrom sizes file' % chrom)
+            continue
+        m = codes == code
+        idx = df.start.values[m] // bin_size
+        nbins = nbins_for_chrom(chromsizes[chrom], bin_size)
+        inside = idx < nbins
+        if not inside.all():
+            log.warn('skipping %d bins of %s beyond the chromosome end' % (
+                (~inside).sum(), chrom))
+        for d, col in ((ipd, 'ip'), (inputd, 'input')):
+            xs = np.zeros(nbins)
+            xs[idx[inside]] = df[col].values[m][inside]
+            d[chrom] = xs
+    return bin_size, ipd, inputd
+
+def read_npz(path, chromsizes):
+    f = np.load(path)
+    bin_size = int(f['bin_size'])
+    offsets = np.concatenate(([0], np.cumsum(f['nbins'])))
+    ip, input = f['ip'], f['input']
+    ipd, inputd = {}, {}
+    for i, chrom in enumerate(f['chroms']):
+        chrom = str(chrom)
+        if not chrom in chromsizes:
+            log.warn('skipping chrom %s of count table, not in chrom sizes file' % chrom)
+            continue
+        nbins = nbins_for_chrom(chromsizes[chrom], bin_size)
+        assert offsets[i + 1] - offsets[i] == nbins, \
+            'count table %s has %d bins for %s, expected %d' % (
+                path, offsets[i + 1] - offsets[i], chrom, nbins)
+        ipd[chrom] = ip[offsets[i]:offsets[i + 1]].astype(np.float64)
+        inputd[chrom] = input[offsets[i]:offsets[i + 1]].astype(np.float64)
+    return bin_size, ipd, inputd
+
+def write_npz(path, bin_size, ipd, inputd):
+    chroms = sorted(set(ipd).intersection(inputd))
+    np.savez(path, bin_size=bin_size, chroms=np.array(chroms),
+             nbins=np.array([len(ipd[c]) for c in chroms]),
+             ip=np.concatenate([ipd[c] for c in chroms]),
+             input=np.concatenate([inputd[c] for c in chroms]))
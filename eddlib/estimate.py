@@ -1,43 +1,137 @@
 from algorithm.max_segments import GenomeBins, IntervalTest
-from algorithm.monte_carlo import MonteCarlo
-from pybedtools import BedTool
-import StringIO
+from algorithm.monte_carlo import MonteCarlo, trial_seeds
+from algorithm.intervals import BinIndex
 import logit
-import tempfile
-import util
-import os
+import time
 from math import sqrt
 from logbook import Logger
-import itertools
-import pandas as pa
-import scipy.stats
+import numpy as np
 log = Logger(__name__)
 
-def corrcoeff(odf):
-    df = pa.DataFrame(dict(left=odf.score[:-1].values,
-                           right=odf.score[1:].values)).dropna()
-    return scipy.stats.spearmanr(df.left, df.right)[0]
-    
-def bin_size(orig_exp, ci_method, nib_lim=0.01, max_ci_diff=0.25, min_corcoef=0.3):
-    for bin_size in itertools.count(1):
-        exp = orig_exp.aggregate_bins(times_bin_size=bin_size)
-        df = logit.ci_for_df(exp.as_data_frame(), ci_method, ci_min=max_ci_diff)
-        ratio_nib = logit.get_nib_ratio(df)
-        pvar = corrcoeff(df)
-        log.notice('testing bin size %d, nib ratio: %.4f, spearmanr: %.3f' % (bin_size, ratio_nib, pvar))
-        if ratio_nib <= nib_lim and pvar > min_corcoef:
-            return exp.bin_size
-        assert bin_size < 100, "Could not find a suitable bin size."
+def average_ranks(xs):
+    '''ranks from 1, ties get their average rank (scipy.stats.rankdata)'''
+    order = np.argsort(xs, kind='mergesort')
+    inv = np.empty(len(order), dtype=np.intp)
+    inv[order] = np.arange(len(order))
+    xs = np.asarray(xs)[order]
+    first = np.r_[True, xs[1:] != xs[:-1]]
+    dense = first.cumsum()[inv]
+    count = np.r_[np.flatnonzero(first), len(first)]
+    return .5 * (count[dense] + count[dense - 1] + 1)
+
+def neighbour_corrcoeff(scores):
+    '''
+    spearman correlation between neighbouring bin scores,
+    pairs with a NaN score are skipped. NaN if it is not defined (fewer
+    than two pairs or constant scores).
+    '''
+    left, right = scores[:-1], scores[1:]
+    ok = np.logical_and(~np.isnan(left), ~np.isnan(right))
+    if ok.sum() < 2:
+        return np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.corrcoef(average_ranks(left[ok]), average_ranks(right[ok]))[1, 0]
+
+
+class PrefixSums(object):
+    '''
+    Cumulative IP and input counts per chromosome of an experiment.
+
+    Counts for any multiple of the base bin size are found by slicing
+    the cumulative sums at the new bin edges, so no aggregated
+    Experiment or data frame needs to be built per candidate bin size.
+    '''
+
+    def __init__(self, exp):
+        common_chroms = sorted(set(exp.ipd).intersection(exp.inputd))
+        self.base_bin_size = exp.bin_size
+        self.chrom_lengths = [len(exp.ipd[c]) for c in common_chroms]
+        self.ip_csums = [self.__csum(exp.ipd[c]) for c in common_chroms]
+        self.input_csums = [self.__csum(exp.inputd[c]) for c in common_chroms]
+        # same normalization as Experiment.normalize_df, the
+        # scale factor does not depend on the bin size.
+        self.input_scale_factor = (sum(x[-1] for x in self.ip_csums) /
+                                   float(sum(x[-1] for x in self.input_csums)))
+
+    @staticmethod
+    def __csum(xs):
+        cs = np.zeros(len(xs) + 1)
+        np.cumsum(xs, out=cs[1:])
+        return cs
+
+    def aggregate(self, n):
+        '''
+        returns genome wide ip and normalized input counts for bins of
+        n times the base bin size. A NaN-separator is placed between
+        chromosomes, the last bin of a chromosome may be partial.
+        '''
+        ips, inputs = [], []
+        sep = np.array([np.nan])
+        for length, ip_cs, input_cs in zip(self.chrom_lengths, self.ip_csums,
+                                           self.input_csums):
+            edges = np.arange(0, length + n, n)
+            edges[-1] = length
+            ips.extend((np.diff(ip_cs[edges]), sep))
+            inputs.extend((np.diff(input_cs[edges]), sep))
+        return (np.concatenate(ips),
+                np.concatenate(inputs) * self.input_scale_factor)
+
+    def evaluate(self, n, ci_method, max_ci_diff):
+        '''returns (nib ratio, neighbour correlation) for n times the base bin size'''
+        return self.evaluate_many([n], ci_method, max_ci_diff)[0][1:]
+
+    def evaluate_many(self, ns, ci_method, max_ci_diff):
+        '''
+        evaluates several candidate bin sizes, the confidence intervals
+        for all candidates are computed in a single vectorized pass.
+        Returns a list of (n, nib ratio, neighbour correlation).
+        '''
+        aggs = [self.aggregate(n) for n in ns]
+        with np.errstate(invalid='ignore'):
+            scores = logit.ci_scores(np.concatenate([ip for ip, _ in aggs]),
+                                     np.concatenate([inp for _, inp in aggs]),
+                                     ci_method, ci_min=max_ci_diff)
+        res = []
+        offset = 0
+        for n, (ip, input) in zip(ns, aggs):
+            xs = scores[offset:offset + len(ip)]
+            offset += len(ip)
+            with np.errstate(invalid='ignore'):
+                nbins_with_reads = (ip + input > 0).sum()
+            nbins_ok = (~np.isnan(xs)).sum()
+            ratio_nib = float(nbins_with_reads - nbins_ok) / nbins_with_reads
+            res.append((n, ratio_nib, neighbour_corrcoeff(xs)))
+        return res
+
+
+def bin_size(orig_exp, ci_method, nib_lim=0.01, max_ci_diff=0.25, min_corcoef=0.3,
+             max_times_bin_size=100, batch_size=8):
+    '''
+    returns the smallest multiple of the experiment bin size satisfying
+    the informative bin and neighbour correlation requirements.
+    Candidates are evaluated batch_size at a time.
+    '''
+    psums = PrefixSums(orig_exp)
+    for first in range(1, max_times_bin_size + 1, batch_size):
+        ns = range(first, min(first + batch_size, max_times_bin_size + 1))
+        for n, ratio_nib, pvar in psums.evaluate_many(ns, ci_method, max_ci_diff):
+            log.notice('testing bin size %d, nib ratio: %.4f, spearmanr: %.3f' % (n, ratio_nib, pvar))
+            if ratio_nib <= nib_lim and pvar > min_corcoef:
+                return orig_exp.bin_size * n
+    raise AssertionError("Could not find a suitable bin size.")
+
+resphi = 2 - (1 + sqrt(5))/2
+
+def golden_probe(m, r):
+    '''a new possible center, in the area between m and r, pushed against m'''
+    return m + resphi*(r - m)
 
 def golden_section_search(f, left, mid, right, precision):
-    phi = (1 + sqrt(5))/2
-    resphi = 2 - phi
 
     def g(l, m, r):
         if abs(l - r) < precision:
             return (l + r)/2.0
-        # Create a new possible center, in the area between c and b, pushed against c
-        mr = m + resphi*(r - m)
+        mr = golden_probe(m, r)
         # log.notice('searching [l=%.2f, m=%.2f, mr=%.2f, r=%.2f]' % (l, m, mr, r))
 
         if f(mr) > f(m):
@@ -48,76 +142,122 @@ def golden_section_search(f, left, mid, right, precision):
             return g(mr, m, l)
     return g(left, mid, right)
 
+def bracketing_search(fs, left, right, precision, nprobes=8):
+    '''
+    Finds the maximum of a unimodal function, like golden_section_search,
+    but probes nprobes evenly spaced points per round. fs scores a list of
+    points at once, so the probes of a round can be run in parallel. Each
+    round narrows the bracket to the grid intervals next to the best probe,
+    until it is narrower than precision.
+    '''
+    assert nprobes >= 2, 'the bracket only narrows with two or more probes'
+    while abs(right - left) >= precision:
+        xs = np.linspace(left, right, nprobes + 2)
+        best = int(np.argmax(fs(list(xs))))
+        left, right = xs[max(best - 1, 0)], xs[min(best + 1, len(xs) - 1)]
+    return (left + right) / 2.0
+
         
 class GapPenalty(object):
 
-    def __init__(self, orig_bins, bedgraph_path, nprocs, gap_file,
-                 mc_trials, pval_lim):
-        assert os.stat(bedgraph_path).st_size > 0
+    def __init__(self, orig_bins, bin_index, nprocs, gap_file,
+                 mc_trials, pval_lim, seed=None):
         self.orig_bins = orig_bins
-        self.bedgraph_path = bedgraph_path
-        self.bins_bedtool = BedTool(self.bedgraph_path)
+        self.bin_index = bin_index
         self.nprocs = nprocs
         self.gap_file = gap_file
         self.mc_trials = mc_trials
         self.pval_lim = pval_lim
+        # one seed per monte carlo trial, so every gap penalty is scored
+        # against the same permutations (common random numbers).
+        self.trial_seeds = trial_seeds(seed, mc_trials)
         self.__cache = {}
-        self.genome_wide_stats = self.count_stats(self.bins_bedtool)
-
-    def cleanup(self):
-        os.remove(self.bedgraph_path) # ugly I know
+        # time spent per batch of scored gap penalties
+        self.penalty_costs = []
+        self.genome_wide_stats = self.bin_index.genome_wide_stats()
+        assert self.genome_wide_stats['EIB'] + self.genome_wide_stats['DIB'] > 0
 
     @classmethod
-    def count_stats(self, xs):
-        '''xs is a bedtool instance where the name field holds the bin score'''
-        stats = {'DIB': 0, 'EIB': 0}
-        for x in xs:
-            if float(x.name) > 0:
-                stats['EIB'] += 1
-            else:
-                stats['DIB'] += 1
-        return stats
-        
-    @classmethod
-    def instantiate(cls, binscore_df, nprocs, gap_file, mc_trials, pval_lim):
+    def instantiate(cls, binscore_df, nprocs, gap_file, mc_trials, pval_lim,
+                    seed=None):
         binscore_gb = GenomeBins.df_as_bins(binscore_df, gap_file)
-        bedgraph_path = tempfile.mktemp()
-        # bin score file is saved because bedtool is used to find bins within peaks.
-        # bedtools intersect requires a file (or creates one from a string without cleaning up
-        # ideally I should use another library for this or implement the functionality myself.
-        # but this works and saves time, albeit ugly...
-        util.save_bin_score_file(binscore_df, bedgraph_path)
-        rval = cls(binscore_gb, bedgraph_path, nprocs, gap_file, mc_trials, pval_lim)
+        # used to count enriched and depleted bins within peaks
+        bin_index = BinIndex.from_df(binscore_df)
+        rval = cls(binscore_gb, bin_index, nprocs, gap_file, mc_trials, pval_lim,
+                   seed)
         return rval
 
 
-    def search(self, left=2.0, mid=10.0, right=30, precision=0.1):
-        return golden_section_search(self.comp_score, left, mid, right,
-                                     precision)
-        
+    def search(self, left=2.0, right=30, precision=0.1, nprobes=8):
+        '''
+        the gap penalty with the best score, found with bracketing_search.
+        The probes of each round share a single monte carlo pass. nprobes
+        does not depend on nprocs, so the estimate of a given seed is the
+        same for any number of processes.
+        '''
+        res = bracketing_search(self.comp_scores, left, right, precision,
+                                nprobes)
+        self.log_score_table()
+        return res
+
     def comp_score(self, gap_penalty):
         '''compute_score_given_gap_penalty'''
-        if gap_penalty in self.__cache:
-            return self.__cache[gap_penalty]['score']
-        
+        return self.comp_scores([gap_penalty])[0]
+
+    def comp_scores(self, gap_penalties):
+        '''
+        scores several gap penalties. The monte carlo trials for all
+        new penalties share a single pass over the permutations. Only
+        that pass is shared, the observed segments and bin stats of each
+        penalty are computed one after another (the segments in
+        parallel threads, see GenomeBins.segment_array).
+        '''
+        # penalties differing by rounding only are scored once
+        gap_penalties = [round(float(x), 9) for x in gap_penalties]
+        todo = []
+        for gap_penalty in gap_penalties:
+            if not gap_penalty in self.__cache and not gap_penalty in todo:
+                todo.append(gap_penalty)
+        if todo:
+            t = time.time()
+            mc_res = MonteCarlo.run_simulation(
+                self.orig_bins.chrom_scores, niter=self.mc_trials,
+                nprocs=self.nprocs, neg_scales=todo, seeds=self.trial_seeds)
+            for i, gap_penalty in enumerate(todo):
+                self.__cache[gap_penalty] = self.__score(gap_penalty, mc_res[:, i])
+            seconds = time.time() - t
+            self.penalty_costs.append({'gap_penalties': todo,
+                                       'mc_trials': self.mc_trials,
+                                       'seconds': seconds})
+            log.notice('scored gap penalties %s in %.2f seconds' % (
+                ', '.join('%.2f' % x for x in todo), seconds))
+        return [self.__cache[x]['score'] for x in gap_penalties]
+
+    def score_table(self):
+        '''the scored gap penalties, ordered by penalty'''
+        return [self.__cache[x] for x in sorted(self.__cache)]
+
+    def log_score_table(self):
+        log.notice('gap penalty  score  potential peaks  coverage (MB)')
+        for d in self.score_table():
+            log.notice('%11.2f  %5.3f  %15d  %13.2f' % (
+                d['gap-penalty'], d['score'], d['npeaks'], d['peak_coverage_mb']))
+
+    def __score(self, gap_penalty, mc_res):
         gb = self.orig_bins.scale_neg_scores(gap_penalty)
-        observed_result = gb.max_segments()
-        mc_res = MonteCarlo.run_simulation(gb.chrom_scores, 
-                                           niter=self.mc_trials, nprocs=self.nprocs)
-        tester = IntervalTest(observed_result, mc_res)
-        segments = [segment for (segment, pval) in tester.pvalues()
-                    if pval < self.pval_lim]
-        if len(segments) == 0:
+        segs = gb.segment_array(nthreads=self.nprocs)
+        pvals = IntervalTest.score_pvalues(segs['score'], np.sort(mc_res))
+        segs = segs[pvals < self.pval_lim]
+        if len(segs) == 0:
             # no potential peaks found
             log.notice('''Gap penalty of %.2f gives a score of 0.0 \
             (0 potential peaks with 0.00MB coverage)''' % gap_penalty)
-            self.__cache[gap_penalty] = {'score': 0.00}
-            return 0.0
-        # TODO use bx.python instead of pybedtools
-        peaks_sb = StringIO.StringIO()
-        tester.segments_to_bedstream(segments, peaks_sb)
-        peaks = BedTool(peaks_sb.getvalue(), from_string=True)
-        d = self.count_stats(self.bins_bedtool.intersect(peaks))
+            return {'gap-penalty': gap_penalty, 'score': 0.00, 'npeaks': 0,
+                    'peak_coverage_mb': 0.0}
+        chroms = np.array(gb.chroms)[segs['segment']]
+        starts = gb.starts[segs['from_idx']]
+        ends = gb.ends[segs['to_idx']]
+        d = self.bin_index.count_stats(chroms, starts, ends)
         d['gap-penalty'] = gap_penalty
         try:
             d['peak_EIB_ratio'] = d['EIB'] / float(d['EIB'] + d['DIB'])
@@ -126,8 +266,9 @@ class GapPenalty(object):
             d['peak_EIB_ratio'] = 0.0
         d['global_EIB_coverage'] = d['EIB'] / float(self.genome_wide_stats['EIB'])
         d['score'] = d['peak_EIB_ratio']**5 * d['global_EIB_coverage']
-        peak_cov = sum(x.end - x.start for x in peaks) / 1e6
+        d['npeaks'] = len(segs)
+        d['peak_coverage_mb'] = (ends - starts).sum() / 1e6
         log.notice('''Gap penalty of %.2f gives a score of %.3f \
-        (%d potential peaks with %.2fMB coverage)''' % (gap_penalty, d['score'], peaks.count(), peak_cov))
-        self.__cache[gap_penalty] = d
-        return d['score']
+        (%d potential peaks with %.2fMB coverage)''' % (
+            gap_penalty, d['score'], d['npeaks'], d['peak_coverage_mb']))
+        return d
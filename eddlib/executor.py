@@ -0,0 +1,167 @@
+'''
+The worker pool all parallel stages submit to.
+
+The executor is configured once (e.g. from --nprocs) with configure()
+and fetched by the stages with get(). Three kinds are supported:
+
+* process -- a multiprocessing pool, the default
+* thread -- a thread pool, for work that releases the GIL
+  (e.g. the monte carlo kernel)
+* serial -- no workers, everything runs in the calling thread
+
+Work that releases the GIL within a stage (e.g. the maximal segments
+kernel) runs on a shared thread pool from threads(), unless the
+configured executor is serial.
+
+This module does not import numpy, so limit_blas_threads can be
+called before numpy is loaded.
+'''
+import os
+import signal
+import threading
+import multiprocessing
+import multiprocessing.pool
+from logbook import Logger
+
+log = Logger(__name__)
+
+kinds = ('process', 'thread', 'serial')
+
+
+def limit_blas_threads():
+    '''
+    EDD runs one worker per core, so BLAS libraries should not start
+    a thread per core in each worker as well. Must be called before
+    numpy is imported, variables already set are kept.
+    '''
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS'):
+        os.environ.setdefault(var, '1')
+
+def _ignore_sigint():
+    # the parent handles ctrl-c and terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class Executor(object):
+
+    def __init__(self, nworkers, kind='process'):
+        assert kind in kinds, 'unknown executor kind: %s' % kind
+        if nworkers <= 1:
+            kind = 'serial'
+        self.kind = kind
+        self.nworkers = max(1, nworkers) if kind != 'serial' else 1
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        '''
+        starts the workers unless running. Worker processes are forked,
+        so start the executor before starting any threads.
+        '''
+        with self.lock:
+            if self.pool is None and self.kind == 'process':
+                # no threads are running while forking
+                _shutdown_threads()
+                self.pool = multiprocessing.Pool(self.nworkers,
+                                                 initializer=_ignore_sigint)
+            elif self.pool is None and self.kind == 'thread':
+                self.pool = multiprocessing.pool.ThreadPool(self.nworkers)
+        return self
+
+    def map(self, f, xs, chunksize=1):
+        '''
+        like map(f, xs), but run by the workers. On KeyboardInterrupt
+        the workers are terminated and the interrupt is raised again.
+        '''
+        if self.kind == 'serial':
+            return map(f, xs)
+        self.start()
+        try:
+            # async makes keyboard interrupt work (and not stall)
+            return self.pool.map_async(f, xs, chunksize=chunksize).get(99999999)
+        except KeyboardInterrupt:
+            log.warn('interrupted, terminating workers')
+            self.shutdown(terminate=True)
+            raise
+
+    def shutdown(self, terminate=False):
+        with self.lock:
+            if self.pool is not None:
+                if terminate:
+                    self.pool.terminate()
+                else:
+                    self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+
+_executor = None
+_configured = False
+_executor_lock = threading.Lock()
+_threads = None
+_threads_lock = threading.Lock()
+
+def configure(nworkers, kind='process'):
+    '''sets the executor used by all stages of the process'''
+    global _executor, _configured
+    _shutdown_threads()
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+        _executor = Executor(nworkers, kind)
+        _configured = True
+        return _executor
+
+def get(nworkers=None):
+    '''
+    the configured executor. If none is configured (e.g. when eddlib is
+    used as a library), a process executor with nworkers (default: one
+    per cpu) is created and kept until a different number is asked for.
+    '''
+    global _executor
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    with _executor_lock:
+        if _executor is None or (not _configured and
+                                 _executor.nworkers != max(1, nworkers)):
+            if _executor is not None:
+                _executor.shutdown()
+            _executor = Executor(nworkers)
+        return _executor
+
+def threads():
+    '''
+    the thread executor for work that releases the GIL, with one thread
+    per worker of the configured executor (default: one per cpu). It is
+    kept until the executor is configured again or shut down, so any
+    number of callers can map on it at the same time. Serial if the
+    configured executor is serial.
+    '''
+    global _threads
+    with _executor_lock:
+        if _configured and _executor.kind == 'serial':
+            return Executor(1, 'serial')
+        nworkers = (_executor.nworkers if _configured
+                    else multiprocessing.cpu_count())
+    with _threads_lock:
+        if _threads is None:
+            _threads = Executor(nworkers, 'thread')
+        return _threads
+
+def _shutdown_threads():
+    global _threads
+    with _threads_lock:
+        if _threads is not None:
+            _threads.shutdown()
+        _threads = None
+
+def shutdown():
+    '''shuts down and forgets the executor and the thread executor'''
+    global _executor, _configured
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+        _executor = None
+        _configured = False
+    _shutdown_threads()
@@ -9,14 +9,18 @@ a data frame to bin objects.
 
 '''
 import functools
+import warnings
 import collections
 import numpy as np
 
 from logbook import Logger
 import pandas as pa
 import read_bam
+import executor
+import count_table
 import logit
 import estimate
+from instrument import RunReport
 
 log = Logger(__name__)
 
@@ -33,21 +37,152 @@ class Experiment(object):
 
     @classmethod
     def load_experiment(cls, chromsizes_path, ip_bam_path,
-            input_bam_path, bin_size=1000, use_multiprocessing=True):
+            input_bam_path, bin_size=1000, use_multiprocessing=True,
+            nprocs=2, cache_dir=None):
+        '''
+        ip_bam_path and input_bam_path are either a single bam file or
+        a list of bam files (e.g. sequencing lanes) whose counts are summed.
+
+        If cache_dir is given, counts are read from and saved to a
+        CountCache in that directory, so each bam file is only counted once.
+        '''
+        return cls.load_experiments(chromsizes_path,
+                [(ip_bam_path, input_bam_path)], bin_size,
+                use_multiprocessing, nprocs, cache_dir)[0]
+
+    @classmethod
+    def load_experiments(cls, chromsizes_path, bam_pairs, bin_size=1000,
+            use_multiprocessing=True, nprocs=2, cache_dir=None):
+        '''
+        loads several experiments (e.g. replicates) from a list of
+        (ip_bam_path, input_bam_path) pairs. Each distinct bam file is
+        counted once, also when shared between experiments (e.g. a common
+        control), and all bam files are counted in the same worker pool.
+        '''
+        chromsizes = cls.read_chrom_sizes(chromsizes_path)
+        lanes = [(cls.as_lanes(ip), cls.as_lanes(ctrl)) for ip, ctrl in bam_pairs]
+        bam_paths = []
+        for ip_lanes, input_lanes in lanes:
+            for p in ip_lanes + input_lanes:
+                if not p in bam_paths:
+                    bam_paths.append(p)
+        counts = {}
+        cache = None
+        if cache_dir is not None:
+            from count_cache import CountCache
+            cache = CountCache(cache_dir, chromsizes, bin_size)
+            for p in bam_paths:
+                cached = cache.get(p)
+                if cached is not None:
+                    counts[p] = cached
+        missing = [p for p in bam_paths if not p in counts]
+        if missing:
+            counted = cls.read_bams(chromsizes, bin_size, missing,
+                                    use_multiprocessing, nprocs)
+            counts.update(zip(missing, counted))
+            if cache is not None:
+                for p in missing:
+                    cache.put(p, counts[p])
+        return [cls(cls.sum_lanes([counts[p] for p in ip_lanes]),
+                    cls.sum_lanes([counts[p] for p in input_lanes]),
+                    bin_size)
+                for ip_lanes, input_lanes in lanes]
+
+    @classmethod
+    def load_counts(cls, chromsizes_path, counts_path):
+        '''
+        loads precomputed ip and input bin counts instead of reading
+        bam files. See count_table for the supported formats.
+        '''
         chromsizes = cls.read_chrom_sizes(chromsizes_path)
+        bin_size, ipd, inputd = count_table.read_count_table(counts_path, chromsizes)
+        log.notice('loaded bin counts of %d chromosomes with bin size %d from %s' % (
+            len(ipd), bin_size, counts_path))
+        return cls(ipd, inputd, bin_size)
+
+    def save_counts(self, path):
+        '''saves the bin counts as a NumPy archive, see load_counts'''
+        count_table.write_npz(path, self.bin_size, self.ipd, self.inputd)
+
+    @classmethod
+    def as_lanes(cls, bam_path):
+        if isinstance(bam_path, basestring):
+            return [bam_path]
+        return list(bam_path)
+
+    @classmethod
+    def sum_lanes(cls, lanes):
+        '''sums the bin counts of chroms present in all lanes'''
+        if len(lanes) == 1:
+            return lanes[0]
+        common_chroms = set.intersection(*[set(d.keys()) for d in lanes])
+        return {chrom: np.sum([d[chrom] for d in lanes], axis=0)
+                for chrom in common_chroms}
+
+    @classmethod
+    def read_bams(cls, chromsizes, bin_size, bam_paths, use_multiprocessing, nprocs):
+        '''
+        counts reads of each bam file. Returns a list with a
+        dict of chrom -> bin counts per bam file.
+        '''
+        ex = executor.get(nprocs) if use_multiprocessing else executor.Executor(1)
+        bam_refs = [read_bam.indexed_references(p) for p in bam_paths]
+        if ex.kind != 'serial' and not None in bam_refs:
+            bam_refs = [set(refs) for refs in bam_refs]
+            return cls.read_bams_by_chrom(chromsizes, bin_size,
+                                          bam_paths, bam_refs, ex)
+        # no index, read each bam front to back.
+        # spare cores are used for bgzf decompression.
         f = functools.partial(read_bam.read_bam_into_bins,
-                            chromsizes, bin_size)
-        if use_multiprocessing:
-            import multiprocessing
-            pool = multiprocessing.Pool(processes=2)
-            # async makes keyboard interrupt work (and not stall)
-            fmap = lambda g, xs: pool.map_async(g, xs).get(99999999)
-        else:
-            fmap = map
+                              chromsizes, bin_size,
+                              threads=max(1, ex.nworkers // len(bam_paths)))
         log.notice('loading bam files')
-        ipd, inputd = fmap(f, [ip_bam_path, input_bam_path])
+        res = ex.map(f, bam_paths)
         log.notice('done')
-        return cls(ipd, inputd, bin_size)
+        return res
+
+    @classmethod
+    def read_bams_by_chrom(cls, chromsizes, bin_size, bam_paths, bam_refs, ex):
+        '''
+        uses the bam indexes to count each chromosome of each bam file
+        as a separate job. Jobs write directly into one preallocated
+        shared array, so only read counts are sent back from the workers.
+        Reads on contigs missing from the chrom sizes file are never decoded.
+        ex is the executor.Executor running the jobs.
+
+        Returns a dict of chrom -> bin counts per bam file.
+        '''
+        from sharedmem import SharedArray
+        chroms = sorted(chromsizes, key=chromsizes.get, reverse=True)
+        offsets = {}
+        nbins_tot = 0
+        for chrom in chroms:
+            offsets[chrom] = nbins_tot
+            nbins_tot += read_bam.nbins_for_chrom(chromsizes[chrom], bin_size)
+        shared = SharedArray(len(bam_paths) * nbins_tot)
+        try:
+            jobs = [(bam_path, chrom, chromsizes[chrom], bin_size,
+                     shared, i * nbins_tot + offsets[chrom])
+                    for chrom in chroms
+                    for i, bam_path in enumerate(bam_paths)
+                    if chrom in bam_refs[i]]
+            log.notice('loading bam files (%d chromosome jobs on %d %s workers)' % (
+                len(jobs), ex.nworkers, ex.kind))
+            ex.map(read_bam.read_chrom_into_shared_bins, jobs)
+            counts = np.array(shared.arr).reshape(len(bam_paths), nbins_tot)
+        finally:
+            shared.unlink()
+        log.notice('done')
+        res = []
+        for i in range(len(bam_paths)):
+            d = {}
+            for chrom in chroms:
+                if not chrom in bam_refs[i]:
+                    continue
+                nbins = read_bam.nbins_for_chrom(chromsizes[chrom], bin_size)
+                d[chrom] = counts[i, offsets[chrom]:offsets[chrom] + nbins]
+            res.append(d)
+        return res
 
 
     def __init__(self, ip_countd, input_countd, bin_size):
@@ -84,23 +219,20 @@ class Experiment(object):
       return d
 
     @classmethod
-    def normalize_df(cls, df):
-        input_scale_factor = df.ip.sum() / float(df.input.sum())
+    def normalize_df(cls, df, inplace=False):
+        input_scale_factor = (df.ip.values.sum(dtype=np.float64) /
+                              df.input.values.sum(dtype=np.float64))
         log.notice('normalizing input with scale factor: %.2f' % input_scale_factor)
-        ndf = df.copy()
-        ndf.input = df.input * input_scale_factor
+        ndf = df if inplace else df.copy()
+        ndf['input'] *= ndf.input.dtype.type(input_scale_factor)
         return ndf
 
     def as_data_frame(self, normalize=True):
-        def chrom_to_df(chrom_name, ip_cnts, input_cnts, bin_size):
-            assert len(ip_cnts) == len(input_cnts)
-            d = collections.OrderedDict()
-            d['chrom'] = chrom_name
-            d['start'] = np.arange(len(ip_cnts)) * bin_size
-            d['end'] = d['start'] + bin_size
-            d['ip'] = ip_cnts
-            d['input'] = input_cnts
-            return pa.DataFrame(d)
+        '''
+        one row per bin. To save memory the chrom column is categorical,
+        coordinates are int32 (if the chromosomes allow it) and counts
+        are float32.
+        '''
         common_chroms = set(self.ipd.keys()).intersection(set(self.inputd.keys()))
         for chrom in self.ipd.keys():
             if not chrom in common_chroms:
@@ -108,19 +240,44 @@ class Experiment(object):
         for chrom in self.inputd.keys():
             if not chrom in common_chroms:
                 log.warn('skipping chrom, Input chrom %s not present in IP.' % chrom)
-        df = pa.concat([chrom_to_df(c, self.ipd[c],
-            self.inputd[c], self.bin_size)
-                        for c in common_chroms],
-            ignore_index=True)
+        chroms = sorted(common_chroms)
+        nbins = [len(self.ipd[c]) for c in chroms]
+        for c, n in zip(chroms, nbins):
+            assert len(self.inputd[c]) == n
+        offsets = np.concatenate(([0], np.cumsum(nbins, dtype=np.intp)))
+        coord_dtype = np.int32 if max(nbins or [0]) * self.bin_size < 2**31 else np.int64
+        starts = np.empty(offsets[-1], dtype=coord_dtype)
+        ip = np.empty(offsets[-1], dtype=np.float32)
+        input = np.empty(offsets[-1], dtype=np.float32)
+        for i, c in enumerate(chroms):
+            lo, hi = offsets[i], offsets[i + 1]
+            starts[lo:hi] = np.arange(nbins[i], dtype=coord_dtype) * self.bin_size
+            ip[lo:hi] = self.ipd[c]
+            input[lo:hi] = self.inputd[c]
+        d = collections.OrderedDict()
+        # pandas stores the codes in the smallest integer type possible
+        d['chrom'] = pa.Categorical.from_codes(
+            np.repeat(np.arange(len(chroms)), nbins), chroms)
+        d['start'] = starts
+        d['end'] = starts + coord_dtype(self.bin_size)
+        d['ip'] = ip
+        d['input'] = input
+        df = pa.DataFrame(d)
         if normalize:
-            return self.normalize_df(df)
+            return self.normalize_df(df, inplace=True)
         else:
             return df
 
 class BamLoader(object):
 
     def __init__(self, chrom_size_path, bin_size, neg_score_scale,
-                 ci_lim=0.25, ci_method='agresti_coull', nib_lim=0.01, number_of_processes=4):
+                 ci_lim=0.25, ci_method='agresti_coull', nib_lim=0.01, number_of_processes=4,
+                 count_cache_dir=None, report=None, seed=None):
+        '''
+        report is an optional instrument.RunReport that
+        records the loading, bin size and scoring stages.
+        seed is used for the gap penalty estimation.
+        '''
         self.chrom_size_path = chrom_size_path
         self.bin_size = bin_size
         self.neg_score_scale = neg_score_scale
@@ -128,30 +285,36 @@ class BamLoader(object):
         self.ci_method = ci_method
         self.nib_lim = nib_lim
         self.number_of_processes = number_of_processes
+        self.count_cache_dir = count_cache_dir
+        self.report = report if report is not None else RunReport()
+        self.seed = seed
 
     def load_bam(self, ip_name, ctrl_name):
         return Experiment.load_experiment(self.chrom_size_path, ip_name,
                 ctrl_name, 1000, # if self.bin_size is None else self.bin_size,
-                use_multiprocessing=True)
+                use_multiprocessing=True, nprocs=self.number_of_processes,
+                cache_dir=self.count_cache_dir)
 
-    def __add_bin_scores(self, r1, r2):
-        assert len(r1.index) == len(r2.index)
-        assert (r1.index == r2.index).all()
-        assert (r1.start == r2.start).all()
-        common = r1.copy()
-        common.score += r2.score
-        return common
+    def load_bams(self, bam_pairs):
+        return Experiment.load_experiments(self.chrom_size_path, bam_pairs,
+                1000, use_multiprocessing=True, nprocs=self.number_of_processes,
+                cache_dir=self.count_cache_dir)
 
     def __adjust_bin_size_and_get_df(self, exp):
         if self.bin_size is None:
-            self.bin_size = estimate.bin_size(exp, self.ci_method,
-                                              max_ci_diff=self.ci_lim,
-                                              nib_lim=self.nib_lim)
+            with self.report.stage('bin_size') as st:
+                self.bin_size = estimate.bin_size(exp, self.ci_method,
+                                                  max_ci_diff=self.ci_lim,
+                                                  nib_lim=self.nib_lim)
+                st['bin_size'] = self.bin_size
             log.notice('Optimal bin size: %d' % self.bin_size)
         else:
             log.notice('Using preset bin size of: %d' % self.bin_size)
-        odf = exp.aggregate_bins(new_bin_size=self.bin_size).as_data_frame()
-        df = logit.ci_for_df(odf, self.ci_method, ci_min=self.ci_lim)
+        with self.report.stage('scoring') as st:
+            odf = exp.aggregate_bins(new_bin_size=self.bin_size).as_data_frame()
+            df = logit.ci_for_df(odf, self.ci_method, ci_min=self.ci_lim,
+                                 inplace=True)
+            st['nbins'] = len(df)
         ratio_nib = logit.get_nib_ratio(df)
         log.notice('''Manually specified bin size of %dKB gives %.2f%% informative bins. \
 The required amount is %.2f%%.''' % (self.bin_size / 1000, (1-ratio_nib)*100, (1-self.nib_lim)*100))
@@ -162,46 +325,82 @@ EDD auto-estimate a bin size for you. Please consult the EDD manual for more inf
         return df
 
     def load_single_experiment(self, ip_name, ctrl_name):
-        self.exp = self.load_bam(ip_name, ctrl_name)
-        self.df = self.__adjust_bin_size_and_get_df(self.exp)
+        with self.report.stage('load'):
+            exp = self.load_bam(ip_name, ctrl_name)
+        self.use_experiment(exp)
+
+    def load_count_table(self, counts_path):
+        '''uses precomputed bin counts instead of bam files'''
+        with self.report.stage('load'):
+            exp = Experiment.load_counts(self.chrom_size_path, counts_path)
+        self.use_experiment(exp)
+
+    def use_experiment(self, exp):
+        'scores an already loaded Experiment'
+        self.exp = exp
+        self.df = self.__adjust_bin_size_and_get_df(exp)
+
+    def use_scores(self, df, bin_size):
+        'uses bins already scored with ci_for_df, e.g. from a checkpoint'
+        self.exp = None
+        self.bin_size = bin_size
+        self.df = df
 
     def load_multiple_experiments(self, ip_names, ctrl_names, which_merge_method='median'):
         assert self.bin_size is not None
         assert len(ip_names) == len(ctrl_names)
-        scores = []
-        for ip_name, ctrl_name in zip(ip_names, ctrl_names):
-            exp = self.load_bam(ip_name, ctrl_name)
+        with self.report.stage('load'):
+            exps = self.load_bams(zip(ip_names, ctrl_names))
+        scores = None
+        for i, exp in enumerate(exps):
             x = self.__adjust_bin_size_and_get_df(exp)
-            scores.append(np.array(x.score))
-        df = x['chrom start end'.split()].copy()
-        scores = pa.DataFrame(np.array(scores).transpose())
-        # TODO support mean, sum and normalized sum in addition to
-        # median
+            if scores is None:
+                df = x['chrom start end'.split()].copy()
+                scores = np.empty((len(exps), len(x)))
+            else:
+                assert (x.chrom.values == df.chrom.values).all()
+                assert (x.start.values == df.start.values).all()
+            scores[i] = x.score.values
         log.info('merging replicate experiments using method: %s' % which_merge_method)
+        df['score'] = self.merge_scores(scores, which_merge_method)
+        self.df = df
+
+    @classmethod
+    def merge_scores(cls, scores, which_merge_method):
+        '''
+        merges a (replicates x bins) array of bin scores into one score per
+        bin. NaN scores (uninformative bins) are ignored.
+        '''
         if which_merge_method == 'median':
-            df['score'] = scores.median(axis=1).values
+            with warnings.catch_warnings():
+                # bins uninformative in all replicates stay NaN
+                warnings.simplefilter('ignore', RuntimeWarning)
+                return np.nanmedian(scores, axis=0)
         elif which_merge_method == 'sum':
-            df['score'] = scores.sum(axis=1).values
+            return np.nansum(scores, axis=0)
         elif which_merge_method == 'normalized-sum':
-            sums = scores.dropna().abs().sum(axis=0)
+            informative = ~np.isnan(scores).any(axis=0)
+            sums = np.abs(scores[:, informative]).sum(axis=1)
             norm_factors = sums / sums.min()
-            df['score'] = (scores / norm_factors).sum(axis=1).values
+            return np.nansum(scores / norm_factors[:, np.newaxis], axis=0)
         else:
             raise Exception('%s is an illegal value for argument `which_merge_method`' % which_merge_method)
-        self.df = df
 
     def get_df(self, unalignable_regions):
         if self.neg_score_scale is None:
             # TODO move this somewhere.
             # does not fit with rest of function
             log.notice('Estimating gap penalty')
-            binscore_df = logit.extrapolate_low_info_bins(self.df)
-            gpe = estimate.GapPenalty.instantiate(
-                binscore_df, self.number_of_processes, unalignable_regions,
-                mc_trials=100, pval_lim=0.05)
-            self.neg_score_scale = gpe.search()
-            gpe.cleanup()
+            with self.report.stage('gap_penalty') as st:
+                binscore_df = logit.extrapolate_low_info_bins(self.df)
+                gpe = estimate.GapPenalty.instantiate(
+                    binscore_df, self.number_of_processes, unalignable_regions,
+                    mc_trials=100, pval_lim=0.05, seed=self.seed)
+                self.neg_score_scale = gpe.search()
+                st['gap_penalty'] = self.neg_score_scale
+                st['penalty_costs'] = gpe.penalty_costs
+                st['penalty_scores'] = gpe.score_table()
             log.notice('Gap penalty estimated to %.1f' % self.neg_score_scale)
 
         df = logit.neg_score_scale(self.df, self.neg_score_scale)
-        return logit.extrapolate_low_info_bins(df)
+        return logit.extrapolate_low_info_bins(df, inplace=True)
@@ -0,0 +1,122 @@
+'''
+Per-stage timing and memory instrumentation.
+
+A RunReport records the duration and memory use of named pipeline
+stages and is saved as json. Memory is read from /proc/self/status
+where available. The peak resident set size is reset before each
+stage, so the reported peak is that of the stage alone. Worker
+processes are only covered by children_peak_rss_mb, which is the
+peak of the largest worker so far.
+
+The reset applies to the whole process, so when several runs share a
+process (edd batch with more than one job) the per stage peaks are not
+reported (peak_rss_mb is null), only the peak of the process.
+'''
+import os
+import sys
+import json
+import time
+import datetime
+import resource
+import contextlib
+from logbook import Logger
+
+log = Logger(__name__)
+
+
+def proc_status_mb(field):
+    'a memory field (e.g. VmRSS or VmHWM) of /proc/self/status in MB'
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+def reset_peak_rss():
+    'resets VmHWM, supported by linux 4.0 and later'
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+def max_rss_mb(who=resource.RUSAGE_SELF):
+    maxrss = resource.getrusage(who).ru_maxrss
+    # bytes on OS X, KB elsewhere
+    return maxrss / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+
+class RunReport(object):
+
+    def __init__(self, profile_stage=None, profile_dir=None,
+                 per_stage_peak_rss=True):
+        '''
+        if profile_stage is given, that stage is run under cProfile and the
+        stats are written to profile_dir. per_stage_peak_rss must be False
+        if other runs use the same process at the same time.
+        '''
+        self.profile_stage = profile_stage
+        self.profile_dir = profile_dir
+        self.per_stage_peak_rss = per_stage_peak_rss
+        self.stages = []
+        self.info = {}
+        self.started = datetime.datetime.now()
+        self.t0 = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        times the enclosed block. Yields the stage dict, so callers can
+        add their own metrics to it.
+        '''
+        d = {'name': name}
+        if self.per_stage_peak_rss:
+            reset_peak_rss()
+        d['rss_before_mb'] = proc_status_mb('VmRSS')
+        profiler = None
+        if name == self.profile_stage:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        t = time.time()
+        try:
+            yield d
+        finally:
+            d['seconds'] = time.time() - t
+            if profiler is not None:
+                profiler.disable()
+                d['profile'] = self.__save_profile(name, profiler)
+            d['rss_after_mb'] = proc_status_mb('VmRSS')
+            d['peak_rss_mb'] = (proc_status_mb('VmHWM') or max_rss_mb()
+                                if self.per_stage_peak_rss else None)
+            d['children_peak_rss_mb'] = max_rss_mb(resource.RUSAGE_CHILDREN)
+            self.stages.append(d)
+            log.notice('stage %s took %.2f seconds' % (name, d['seconds']))
+
+    def __save_profile(self, name, profiler):
+        import pstats
+        path = os.path.join(self.profile_dir or '.', 'profile_%s' % name)
+        profiler.dump_stats(path + '.prof')
+        with open(path + '.txt', 'w') as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats('cumulative').print_stats(40)
+        log.notice('profile of stage %s written to %s.prof' % (name, path))
+        return path + '.prof'
+
+    def as_dict(self):
+        d = dict(self.info)
+        d['started'] = self.started.isoformat()
+        d['total_seconds'] = time.time() - self.t0
+        d['peak_rss_mb'] = max_rss_mb()
+        d['per_stage_peak_rss'] = self.per_stage_peak_rss
+        d['children_peak_rss_mb'] = max_rss_mb(resource.RUSAGE_CHILDREN)
+        d['stages'] = self.stages
+        return d
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+            f.write('\n')
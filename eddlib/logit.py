@@ -1,43 +1,139 @@
 import numpy as np
+import pandas as pa
 from logbook import Logger
-from statsmodels.stats.proportion import proportion_confint
+from scipy.special import ndtri, betaincinv
 
 log = Logger(__name__)
 
+ci_methods = ('normal', 'agresti_coull', 'beta', 'wilson', 'jeffrey')
+# evaluating these intervals is expensive, so they are only
+# computed once per distinct (count, nobs) pair
+beta_ci_methods = ('beta', 'jeffrey')
+
 def logit(xs):
     return np.log(xs) - np.log(1 - xs)
 
 def get_medians(df):
-    neg = np.median(df.ix[df.score < 0].score)
-    pos = np.median(df.ix[df.score > 0].score)
+    'medians of the negative and positive scores, NaN scores are ignored'
+    scores = df.score.values
+    with np.errstate(invalid='ignore'):
+        neg = np.median(scores[scores < 0])
+        pos = np.median(scores[scores > 0])
     return neg, pos
 
-def ci_for_df(odf, ci_method, ci_min=0.25):
-    df = odf.copy()
-    df['tot_reads'] = df.ip + df.input
-    df['avg'] = df.ip / df.tot_reads.astype(float)
-    assert ci_method in ('normal', 'agresti_coull',
-                         'beta', 'wilson', 'jeffrey')
-    df['ci_low'], df['ci_high'] = proportion_confint(df.ip, df.tot_reads,
-                                                     method=ci_method)
-    df['ci_diff'] = df.ci_high - df.ci_low
-    has_ip_and_ctr_reads = np.logical_and(df.ip > 0, df.input > 0)
-    small_CI = np.logical_and(df.ci_diff < ci_min, has_ip_and_ctr_reads)
-    df['score'] = logit(df.ix[small_CI].avg)
+def ci_for_df(odf, ci_method, ci_min=0.25, inplace=False):
+    '''
+    adds the columns tot_reads and score (float32) to a frame of ip and
+    input counts. Modifies odf if inplace is set, otherwise a copy.
+    '''
+    df = odf if inplace else odf.copy()
+    ip = df.ip.values
+    input = df.input.values
+    df['tot_reads'] = ip + input
+    df['score'] = ci_scores(ip, input, ci_method,
+                            ci_min=ci_min).astype(np.float32)
     return df
 
+def ci_scores(ip, input, ci_method, ci_min=0.25):
+    '''
+    scores arrays of ip and input counts.
+    Returns an array of scores with NaN for non-informative bins.
+    '''
+    assert ci_method in ci_methods
+    score = np.empty(len(ip))
+    score.fill(np.nan)
+    with np.errstate(invalid='ignore'):
+        idx = np.flatnonzero(np.logical_and(ip > 0, input > 0))
+    ip = ip[idx]
+    tot_reads = ip + input[idx]
+    if ci_method in beta_ci_methods:
+        ip, tot_reads, codes = unique_pairs(ip, tot_reads)
+    small_CI = ci_widths(ip, tot_reads, ci_method) < ci_min
+    avg = ip / tot_reads
+    pair_scores = np.where(small_CI, logit(avg), np.nan)
+    if ci_method in beta_ci_methods:
+        pair_scores = pair_scores[codes]
+    score[idx] = pair_scores
+    return score
+
+def unique_pairs(xs, ys):
+    '''
+    the distinct (x, y) pairs as arrays us and vs, and the
+    codes with xs == us[codes] and ys == vs[codes]
+    '''
+    x_codes, x_uniques = pa.factorize(xs)
+    y_codes, y_uniques = pa.factorize(ys)
+    codes, pairs = pa.factorize(x_codes.astype(np.int64) * len(y_uniques) + y_codes)
+    us = x_uniques[pairs // len(y_uniques)].astype(xs.dtype)
+    vs = y_uniques[pairs % len(y_uniques)].astype(ys.dtype)
+    return us, vs, codes
+
+def ci_widths(count, nobs, ci_method, alpha=0.05):
+    '''
+    widths of the binomial proportion confidence intervals of count
+    successes in nobs trials. Computes the same intervals as
+    statsmodels.stats.proportion.proportion_confint.
+    '''
+    q = count / nobs
+    if ci_method in ('normal', 'agresti_coull', 'wilson'):
+        crit = -ndtri(alpha / 2.)
+        if ci_method == 'normal':
+            center = q
+            dist = q * (1 - q)
+            dist /= nobs
+        elif ci_method == 'agresti_coull':
+            nobs_c = nobs + crit**2
+            center = (count + crit**2 / 2.) / nobs_c
+            dist = center * (1. - center)
+            dist /= nobs_c
+        else:
+            crit2 = crit**2
+            denom = 1 + crit2 / nobs
+            center = (q + crit2 / (2 * nobs)) / denom
+            dist = q * (1. - q)
+            dist /= nobs
+            dist += crit2 / (4. * nobs**2)
+        np.sqrt(dist, out=dist)
+        dist *= crit
+        if ci_method == 'wilson':
+            dist /= denom
+        upp = center + dist
+        # the wilson interval always lies within [0, 1]
+        if ci_method != 'wilson':
+            np.clip(upp, 0, 1, out=upp)
+        low = np.subtract(center, dist, out=dist)
+        if ci_method != 'wilson':
+            np.clip(low, 0, 1, out=low)
+        upp -= low
+        return upp
+    elif ci_method == 'beta':
+        with np.errstate(invalid='ignore'):
+            upp = betaincinv(count + 1, nobs - count, 1 - alpha / 2.)
+            low = betaincinv(count, nobs - count + 1, alpha / 2.)
+        upp[q == 1] = 1
+        low[q == 0] = 0
+    else:
+        # jeffrey, a central interval
+        a, b = count + 0.5, nobs - count + 0.5
+        upp = betaincinv(a, b, (1 + (1 - alpha)) / 2.)
+        low = betaincinv(a, b, (1 - (1 - alpha)) / 2.)
+    upp -= low
+    return upp
+
 def get_nib_ratio(df):
     nbins_with_reads = (df.tot_reads > 0).sum()
     nbins_ok = len(df.score.dropna())
     return float(nbins_with_reads - nbins_ok) / nbins_with_reads
 
-def extrapolate_low_info_bins(odf):
-    df = odf.copy()
-    median_neg, median_pos = get_medians(df.dropna())
-    df.ix[np.isnan(df.score), 'score'] = median_neg
+def extrapolate_low_info_bins(odf, inplace=False):
+    df = odf if inplace else odf.copy()
+    median_neg, median_pos = get_medians(df)
+    df.loc[np.isnan(df.score.values), 'score'] = median_neg
     return df
-    
-def neg_score_scale(odf, scale):
-    df = odf.copy()
-    df.ix[df.score < 0, 'score'] *= scale
+
+def neg_score_scale(odf, scale, inplace=False):
+    df = odf if inplace else odf.copy()
+    with np.errstate(invalid='ignore'):
+        neg = df.score.values < 0
+    df.loc[neg, 'score'] *= scale
     return df
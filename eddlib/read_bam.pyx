@@ -1,8 +1,9 @@
 from libc.stdlib cimport calloc, free
 import numpy as np
 cimport numpy as np
-from pysam.libchtslib cimport bam1_t, bam1_core_t
+from pysam.libchtslib cimport bam1_t, bam1_core_t, hts_set_threads
 from pysam.libcsamfile cimport Samfile
+from pysam.libcalignmentfile cimport IteratorRowRegion
 
 
 cdef np.ndarray[np.float64_t] \
@@ -25,11 +26,43 @@ cdef np.ndarray[np.float64_t] \
 def aggregate_every_n_bins(bins_by_chrom, n):
   return {k:agg_n(xs, n) for k, xs in bins_by_chrom.items()}
 
-def read_bam_into_bins(chrom_sizes, bin_size, bam_filename):
-  b = BamCounter(chrom_sizes, bam_filename, bin_size)
+def read_bam_into_bins(chrom_sizes, bin_size, bam_filename, threads=1):
+  b = BamCounter(chrom_sizes, bam_filename, bin_size, threads=threads)
   b.process_bam()
   return b.chrom_bins
 
+def read_chrom_into_shared_bins(args):
+  '''
+  counts the reads of a single chromosome into a slice of a SharedArray.
+  args is a tuple (bam_filename, chrom, chrom_size, bin_size, shared, offset)
+  so that the function can be used with Pool.map.
+  '''
+  bam_filename, chrom, chrom_size, bin_size, shared, offset = args
+  nbins = nbins_for_chrom(chrom_size, bin_size)
+  out = {chrom: shared.arr[offset:offset + nbins]}
+  b = BamCounter({chrom: chrom_size}, bam_filename, bin_size, out=out)
+  return b.process_chrom(chrom)
+
+def nbins_for_chrom(chrom_size, bin_size):
+  nbins = int(chrom_size / bin_size)
+  if chrom_size % bin_size != 0:
+    nbins += 1
+  return nbins
+
+def indexed_references(bam_filename):
+  '''
+  returns the reference names of an indexed bam file,
+  or None if the file has no index.
+  '''
+  fp = Samfile(bam_filename)
+  try:
+    fp.check_index()
+    return list(fp.references)
+  except (ValueError, AttributeError):
+    return None
+  finally:
+    fp.close()
+
 cdef class BamCounter:
   cdef:
     object chrom_sizes
@@ -40,13 +73,20 @@ cdef class BamCounter:
     Samfile fp
     size_t bin_size
 
-  def __cinit__(self, chrom_sizes, bam_filename, bin_size):
+  def __cinit__(self, chrom_sizes, bam_filename, bin_size, threads=1, out=None):
     self.fp = Samfile(bam_filename)
     self.cb_len = self.fp.nreferences
     self.cb = <double**> calloc(self.cb_len, sizeof(double*));
     self.cnbins = <size_t*> calloc(self.cb_len, sizeof(size_t))
+    if threads > 1:
+      # multithreaded bgzf decompression
+      hts_set_threads(self.fp.htsfile, threads)
 
-  def __init__(self, chrom_sizes, bam_filename, bin_size):
+  def __init__(self, chrom_sizes, bam_filename, bin_size, threads=1, out=None):
+    '''
+    out is an optional dict of chrom -> preallocated, zeroed float64 arrays
+    (e.g. views into shared memory) to count into.
+    '''
     self.chrom_sizes = chrom_sizes
     self.bin_size = bin_size
     self.chrom_bins = {}
@@ -59,45 +99,65 @@ cdef class BamCounter:
         self.cb[i] = NULL
         self.cnbins[i] = 0
       else:
-        chrom_size = self.chrom_sizes[chrom_name]
-        nbins = int(chrom_size / bin_size)
-        if chrom_size % bin_size != 0:
-          nbins += 1
-        a = np.zeros(nbins, dtype=np.float64)
+        nbins = nbins_for_chrom(self.chrom_sizes[chrom_name], bin_size)
+        if out is not None and chrom_name in out:
+          a = out[chrom_name]
+          assert len(a) == nbins and a.flags.c_contiguous
+        else:
+          a = np.zeros(nbins, dtype=np.float64)
         self.chrom_bins[chrom_name] = a
         self.cb[i] = <double *> a.data
         self.cnbins[i] = nbins
 
-  def process_bam(self):
+  cdef inline int add_read(self, bam1_t *b):
+    '''adds a read to its bin(s), returns 1 if counted, 0 otherwise'''
     cdef:
-      bam1_t *b
-      size_t start, cov, sidx
-      size_t nreads = 0
+      size_t start, sidx
       size_t start_to_bin_end
       double r
+    if (b.core.flag & 0x4 or
+        b.core.tid < 0 or
+        self.cb[b.core.tid] == NULL or
+        b.core.pos == 0):
+      return 0
+    start = b.core.pos - 1 # bam 1-based, bed is 0-based
+    sidx = start / self.bin_size
+    start_to_bin_end = self.bin_size - (start % self.bin_size)
+    if b.core.l_qseq < start_to_bin_end:
+      # the whole sequence fits within a bin
+      assert(self.cnbins[b.core.tid] > sidx)
+      self.cb[b.core.tid][sidx] += 1
+    else:
+      # the sequence spans two bins
+      r = start_to_bin_end / <double>b.core.l_qseq;
+      self.cb[b.core.tid][sidx] += r
+      if (self.cnbins[b.core.tid] > (sidx + 1)):
+        # only add to next bin if present (ok to drop if not)
+        self.cb[b.core.tid][sidx + 1] += (1 - r)
+    return 1
+
+  def process_bam(self):
+    '''reads the whole bam file front to back'''
+    cdef size_t nreads = 0
     while self.fp.cnext() >= 0:
-      b = self.fp.getCurrent()
-      if (b.core.flag & 0x4 or
-          self.cb[b.core.tid] == NULL or
-          b.core.pos == 0):
-        continue
-      nreads += 1
-      start = b.core.pos - 1 # bam 1-based, bed is 0-based
-      sidx = start / self.bin_size
-      start_to_bin_end = self.bin_size - (start % self.bin_size)
-      if b.core.l_qseq < start_to_bin_end:
-        # the whole sequence fits within a bin
-        assert(self.cnbins[b.core.tid] > sidx)
-        self.cb[b.core.tid][sidx] += 1
-      else:
-        # the sequence spans two bins
-        r = start_to_bin_end / <double>b.core.l_qseq;
-        self.cb[b.core.tid][sidx] += r
-        if (self.cnbins[b.core.tid] > (sidx + 1)):
-          # only add to next bin if present (ok to drop if not)
-          self.cb[b.core.tid][sidx + 1] += (1 - r)
+      nreads += self.add_read(self.fp.getCurrent())
     return nreads;
 
+  def process_chrom(self, chrom):
+    '''
+    uses the bam index to read only the records of a single chromosome.
+    '''
+    cdef:
+      IteratorRowRegion it
+      size_t nreads = 0
+    it = self.fp.fetch(chrom)
+    # IteratorRowRegion.cnext stores its return code in retval
+    it.cnext()
+    while it.retval >= 0:
+      nreads += self.add_read(it.getCurrent())
+      it.cnext()
+    return nreads
+
   def __dealloc__(self):
     free(self.cb)
     free(self.cnbins)
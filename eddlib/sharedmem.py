@@ -0,0 +1,53 @@
+'''
+numpy arrays that can be shared with worker processes by name.
+
+Arrays are backed by a file in /dev/shm (or the temp dir if /dev/shm
+is not available) and pickle to their path, so passing one to a
+multiprocessing pool does not copy the data. The process that created
+the array owns the backing file and must call unlink() when done.
+'''
+import os
+import tempfile
+import numpy as np
+
+
+def _shm_dir():
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class SharedArray(object):
+
+    def __init__(self, shape, dtype=np.float64, path=None):
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='edd-', suffix='.shm',
+                                        dir=_shm_dir())
+            os.close(fd)
+            self.owner = True
+            mode = 'w+'
+        else:
+            self.owner = False
+            mode = 'r+'
+        self.path = path
+        self.arr = np.memmap(path, dtype=self.dtype, mode=mode, shape=shape)
+
+    @classmethod
+    def from_array(cls, xs):
+        sa = cls(xs.shape, xs.dtype)
+        sa.arr[:] = xs
+        return sa
+
+    def __getstate__(self):
+        return self.path, self.shape, self.dtype.str
+
+    def __setstate__(self, state):
+        path, shape, dtype = state
+        self.__init__(shape, dtype, path=path)
+
+    def unlink(self):
+        'removes the backing file, existing mappings stay valid.'
+        if self.owner and os.path.exists(self.path):
+            os.remove(self.path)
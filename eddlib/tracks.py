@@ -0,0 +1,238 @@
+'''
+Writes bin and peak tracks (bedGraph and bed files) from arrays.
+
+The lines are formatted a chunk of rows at a time straight from the
+column arrays, with the same number formatting as DataFrame.to_csv
+(shortest repr of the float, an empty field for nan), so no data frame
+or per row python objects are needed.
+
+Compressed output is written as BGZF: a gzip file of independent
+members of at most 64KB, readable by gzip/zcat and indexable by tabix.
+The members are compressed by a pool of threads (zlib releases the
+GIL), while the main thread formats the next chunk.
+
+Tracks can also be saved in a binary format, a NumPy archive of the
+sorted columns with the row offsets of each chromosome (see NpzTrack).
+'''
+import zlib
+import struct
+import collections
+import multiprocessing.pool
+import numpy as np
+from logbook import Logger
+
+log = Logger(__name__)
+
+formats = ('bedgraph', 'bedgraph.gz', 'npz')
+
+chunk_rows = 1 << 16
+
+# htslib fills blocks up to 0xff00 bytes, so a block of incompressible
+# data still fits the 16 bit block size.
+bgzf_block_size = 0xff00
+bgzf_eof = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC'
+            '\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+
+def bgzf_block(data, level=6):
+    '''data (at most bgzf_block_size bytes) as one BGZF member'''
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                         ord('B'), ord('C'), 2, len(cdata) + 25)
+    return ''.join((header, cdata,
+                    struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                                len(data) & 0xffffffff)))
+
+def bgzf_blocks(data, level=6):
+    return ''.join(bgzf_block(data[i:i + bgzf_block_size], level)
+                   for i in xrange(0, len(data), bgzf_block_size))
+
+
+class BgzfWriter(object):
+    '''
+    file-like BGZF writer. With nthreads > 1 the blocks are compressed
+    by that many threads, the output is the same.
+    '''
+
+    # bytes handed to a thread at a time
+    batch_size = 16 * bgzf_block_size
+
+    def __init__(self, path, nthreads=1, level=6):
+        self.f = open(path, 'wb')
+        self.name = path
+        self.level = level
+        self.buf = []
+        self.buf_len = 0
+        self.pending = collections.deque()
+        self.max_pending = 2 * nthreads
+        self.pool = (multiprocessing.pool.ThreadPool(nthreads)
+                     if nthreads > 1 else None)
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self.batch_size:
+            self.__submit(self.__take(self.buf_len // bgzf_block_size
+                                      * bgzf_block_size))
+
+    def __take(self, n):
+        data = ''.join(self.buf)
+        self.buf = [data[n:]] if len(data) > n else []
+        self.buf_len = len(data) - n
+        return data[:n]
+
+    def __submit(self, data):
+        if self.pool is None:
+            self.f.write(bgzf_blocks(data, self.level))
+            return
+        self.pending.append(self.pool.apply_async(bgzf_blocks,
+                                                  (data, self.level)))
+        # in order, and at most max_pending batches in memory
+        while len(self.pending) > self.max_pending:
+            self.f.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.f.closed:
+            return
+        try:
+            if self.buf_len:
+                self.__submit(self.__take(self.buf_len))
+            while self.pending:
+                self.f.write(self.pending.popleft().get())
+            self.f.write(bgzf_eof)
+        finally:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def column_strings(xs):
+    '''values as strings formatted like DataFrame.to_csv'''
+    xs = np.asarray(xs)
+    if xs.dtype.kind in 'iu':
+        return map(str, xs.tolist())
+    strs = xs.astype(str)
+    if xs.dtype.kind == 'f':
+        strs[np.isnan(xs)] = ''
+    return strs.tolist()
+
+def format_lines(chrom, columns):
+    '''bed lines of a chrom and a list of columns, each a list of strings'''
+    template = chrom.replace('%', '%%') + '\t%s' * len(columns) + '\n'
+    return ''.join(map(template.__mod__, zip(*columns)))
+
+def write_bed(f, chrom_names, chrom_codes, starts, ends, columns,
+              value_format=column_strings):
+    '''
+    writes bed lines to the file-like f, the chrom of row i is
+    chrom_names[chrom_codes[i]] and columns is a list of value arrays.
+    Rows are written in the given order.
+    '''
+    chrom_names = [str(x) for x in chrom_names]
+    chrom_codes = np.asarray(chrom_codes)
+    for lo in xrange(0, len(starts), chunk_rows):
+        hi = min(lo + chunk_rows, len(starts))
+        lines = [column_strings(starts[lo:hi]), column_strings(ends[lo:hi])]
+        lines += [value_format(xs[lo:hi]) for xs in columns]
+        # the chrom is the same for a run of rows
+        codes = chrom_codes[lo:hi]
+        runs = np.concatenate(([0], np.flatnonzero(codes[1:] != codes[:-1]) + 1,
+                               [hi - lo]))
+        f.write(''.join(format_lines(chrom_names[codes[a]],
+                                     [xs[a:b] for xs in lines])
+                        for a, b in zip(runs[:-1], runs[1:])))
+
+def chrom_codes(chroms):
+    '''
+    codes and names of a chrom column, ordered as sort_values orders
+    it: by category for a categorical column, else by name.
+    '''
+    if hasattr(chroms, 'cat'):
+        return (np.asarray(chroms.cat.codes.values),
+                [str(x) for x in chroms.cat.categories])
+    codes, names = np.unique(np.asarray(chroms).astype(str),
+                             return_inverse=True)[::-1]
+    return codes, names.tolist()
+
+def sort_order(codes, starts):
+    '''rows sorted by chrom, then start, like sort_values (stable)'''
+    return np.lexsort((starts, codes))
+
+
+def write_track(path, chroms, starts, ends, columns, fmt='bedgraph',
+                nthreads=1, sort=True):
+    '''
+    writes a track of the bins chroms (a chrom column, e.g. df.chrom),
+    starts, ends and one or more value columns. fmt is one of formats,
+    bedgraph.gz is BGZF compressed and tabix indexed (if sorted and
+    path ends in .gz).
+    '''
+    assert fmt in formats, 'unknown track format: %s' % fmt
+    codes, names = chrom_codes(chroms)
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    columns = [np.asarray(xs) for xs in columns]
+    if sort:
+        order = sort_order(codes, starts)
+        codes, starts, ends = codes[order], starts[order], ends[order]
+        columns = [xs[order] for xs in columns]
+    if fmt == 'npz':
+        NpzTrack.write(path, names, codes, starts, ends, columns)
+    elif fmt == 'bedgraph.gz':
+        with BgzfWriter(path, nthreads) as f:
+            write_bed(f, names, codes, starts, ends, columns)
+        if sort and path.endswith('.gz'):
+            tabix_index(path)
+        elif sort:
+            # pysam would compress path again, as it does not end in .gz
+            log.warn('%s does not end in .gz, it is not tabix indexed' % path)
+    else:
+        with open(path, 'w') as f:
+            write_bed(f, names, codes, starts, ends, columns)
+
+def tabix_index(path):
+    '''writes path.tbi, path must be BGZF compressed, sorted and end in .gz'''
+    import pysam
+    pysam.tabix_index(path, preset='bed', force=True)
+
+
+class NpzTrack(object):
+    '''
+    a binary track: the chrom names, the row offsets of each chrom and
+    the start, end and value columns, sorted by chrom and start.
+    '''
+
+    def __init__(self, path):
+        f = np.load(path)
+        self.chroms = [str(x) for x in f['chroms']]
+        self.offsets = f['offsets']
+        self.starts = f['starts']
+        self.ends = f['ends']
+        self.values = f['values']
+
+    @staticmethod
+    def write(path, chrom_names, chrom_codes, starts, ends, columns):
+        '''the rows must be sorted by chrom code, then start'''
+        counts = np.bincount(chrom_codes, minlength=len(chrom_names))
+        present = counts > 0
+        np.savez(path, chroms=np.array(chrom_names)[present],
+                 offsets=np.concatenate(([0], np.cumsum(counts[present]))),
+                 starts=starts, ends=ends,
+                 values=np.column_stack(columns) if columns else
+                 np.empty((len(starts), 0)))
+
+    def query(self, chrom, start=0, end=None):
+        '''starts, ends and values of the bins of chrom overlapping start-end'''
+        i = self.chroms.index(chrom)
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        ends = self.ends[lo:hi]
+        a = lo + np.searchsorted(ends, start, side='right')
+        b = hi if end is None else lo + np.searchsorted(self.starts[lo:hi], end)
+        return self.starts[a:b], self.ends[a:b], self.values[a:b]
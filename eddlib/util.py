@@ -1,15 +1,33 @@
 from collections import namedtuple
 import math
+import numpy as np
 from logbook import Logger
+from eddlib import tracks
 
 log = Logger(__name__)
 bed = namedtuple('BedGraph', 'chrom start end score')
 bin = namedtuple('Bin', 'chrom start end ip_count input_count')
 
-def save_bin_score_file(df, ratio_file):
-    columns = 'chrom start end score'.split()
-    x = df[columns].sort_values(by = ['chrom', 'start'])
-    x.to_csv(ratio_file, sep='\t', index=False, header=False)
+def save_bin_score_file(df, ratio_file, fmt='bedgraph', nthreads=1):
+    '''writes the bin scores sorted by chrom and start'''
+    tracks.write_track(ratio_file, df.chrom, df.start.values,
+                              df.end.values, [df.score.values],
+                              fmt=fmt, nthreads=nthreads)
+
+def fdr_bh(pvals):
+    '''
+    Benjamini-Hochberg adjusted p-values, the same as
+    statsmodels' multipletests(pvals, method='fdr_bh')[1].
+    '''
+    pvals = np.asarray(pvals, dtype=float)
+    n = len(pvals)
+    order = np.argsort(pvals)
+    adjusted = pvals[order] / (np.arange(1, n + 1) / float(n))
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    adjusted[adjusted > 1] = 1
+    qvals = np.empty(n)
+    qvals[order] = adjusted
+    return qvals
 
 def ci_lower_bound(pos, neg):
     '''
@@ -1,4 +1,4 @@
-import os, sys
+import os, sys, re
 from setuptools import setup
 from distutils.extension import Extension
 
@@ -46,8 +46,14 @@ try:
 except ImportError:
     raise Exception('please install cython first, e.g.: pip install --upgrade cython')
 
+def read_version():
+    # eddlib is not imported, its dependencies may not be installed yet
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'eddlib', '__init__.py')) as f:
+        return re.search(r"^__version__ = '(.*)'", f.read(), re.M).group(1)
+
 setup(name='edd',
-      version='1.1.19',
+      version=read_version(),
       description='Enriched domain detector for ChIP-seq data',
       url='http://github.com/CollasLab/edd',
       author='Eivind G. Lund',
@@ -63,9 +69,6 @@ setup(name='edd',
           ],
       install_requires=[
           'Logbook',
-          'pybedtools',
-          'statsmodels',
-          'patsy', # statsmodels dependency
           'pandas',
           'python-dateutil', # pandas dependency
           'scipy',
@@ -77,6 +80,9 @@ setup(name='edd',
                  sources=['eddlib/read_bam.pyx'],
                  include_dirs=pysam.get_include() + [np.get_include()],
                  define_macros=pysam.get_defines(),
+                 # htslib symbols (e.g. hts_set_threads) are resolved from pysam
+                 extra_link_args=[x for x in pysam.get_libraries()
+                                  if os.path.basename(x).startswith('libchtslib')],
                  ),
         Extension('eddlib.algorithm.chrom_max_segments',
                   sources=['eddlib/algorithm/chrom_max_segments.pyx'],
@@ -0,0 +1,60 @@
+from benchmarks import synthetic
+import StringIO
+import subprocess
+import imp
+import sys
+import os
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+edd_script = os.path.join(root, 'bin', 'edd')
+edd = imp.load_source('edd_script', edd_script)
+
+def read_manifest(text):
+    return edd.read_manifest(StringIO.StringIO(text))
+
+def test_read_manifest():
+    samples = read_manifest('''\
+# a comment before the header
+name\tip\tinput\tgap_penalty
+
+a\tip1.bam,ip2.bam\tinput.bam\t
+# a comment
+b\tip3.bam\tinput.bam\t12.5
+''')
+    assert [x['name'] for x in samples] == ['a', 'b']
+    assert samples[0]['ip'] == 'ip1.bam,ip2.bam'
+    assert samples[0]['gap_penalty'] is None
+    assert samples[1]['gap_penalty'] == 12.5
+    assert samples[1]['bin_size'] is None
+
+@pytest.mark.parametrize('text,message', [
+    ('name\tip\ta\tip.bam\n', 'missing the columns: input'),
+    ('name\tip\tinput\na\tip.bam\n', 'line 2 of the manifest has 2 columns'),
+    ('name\tip\tinput\na\tip.bam\tinput.bam\na\tip2.bam\tinput.bam\n',
+     'must be unique'),
+    ('# only a comment\nname\tip\tinput\n', 'no samples')])
+def test_read_manifest_errors(text, message):
+    with pytest.raises(AssertionError) as e:
+        read_manifest(text)
+    assert message in str(e.value)
+
+def test_batch_jobs(tmpdir):
+    d = synthetic.make_dataset(str(tmpdir.join('data')), genome_size=4000000,
+                               nchroms=2, coverage=0.2, domain_size=200000)
+    manifest = str(tmpdir.join('manifest.tsv'))
+    with open(manifest, 'w') as f:
+        f.write('name\tip\tinput\tgap_penalty\n')
+        f.write('s1\t%s\t%s\t\n' % (d['ip'], d['input']))
+        f.write('s2\t%s\t%s\t5\n' % (d['ip'], d['input']))
+    out = str(tmpdir.join('out'))
+    env = dict(os.environ, PYTHONPATH=root)
+    subprocess.check_call([sys.executable, edd_script, 'batch', d['chrom_sizes'],
+                           d['unalignable_regions'], manifest, out, '-j', '2',
+                           '-p', '2', '-n', '100', '--seed', '1',
+                           '--bin-size', '50', '--gap-penalty', '10'], env=env)
+    for name, gap_penalty in (('s1', '10.00'), ('s2', '5.00')):
+        assert os.path.isfile(os.path.join(out, name, name + '_peaks.bed'))
+        log = open(os.path.join(out, name, 'log.txt')).read()
+        assert 'gap penalty: %s' % gap_penalty in log
+    assert 'sample s1 done' in open(os.path.join(out, 'batch_log.txt')).read()
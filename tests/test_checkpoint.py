@@ -0,0 +1,48 @@
+from eddlib.checkpoint import Checkpoints
+from eddlib.algorithm.max_segments import segments_as_arrays, segments_from_arrays
+from eddlib import util
+import numpy as np
+import pandas as pa
+import os
+
+def test_roundtrip(tmpdir):
+    ckpt = Checkpoints(str(tmpdir.join('ckpt')))
+    key = ckpt.key('monte_carlo', 'parent', num_trials=10, seed=1)
+    assert ckpt.load('monte_carlo', key) is None
+    ckpt.save('monte_carlo', key, info={'seed': 1}, mc_res=np.arange(10.0))
+    entry = ckpt.load('monte_carlo', key)
+    assert (entry['mc_res'] == np.arange(10.0)).all()
+    assert entry['info'] == {'seed': 1}
+    assert ckpt.resumed == ['monte_carlo']
+    assert ckpt.saved_seed() == 1
+
+def test_invalidated(tmpdir):
+    ckpt = Checkpoints(str(tmpdir.join('ckpt')))
+    key = ckpt.key('monte_carlo', 'parent', num_trials=10)
+    assert key != ckpt.key('monte_carlo', 'parent', num_trials=20)
+    assert key != ckpt.key('monte_carlo', 'other parent', num_trials=10)
+    ckpt.save('monte_carlo', key, mc_res=np.zeros(1))
+    new_key = ckpt.key('monte_carlo', 'parent', num_trials=20)
+    ckpt.save('monte_carlo', new_key, mc_res=np.ones(1))
+    # only the latest entry of a stage is kept
+    assert ckpt.load('monte_carlo', key) is None
+    assert len(os.listdir(ckpt.directory)) == 1
+    assert Checkpoints(ckpt.directory, enabled=False).load('monte_carlo', new_key) is None
+
+def test_df_roundtrip(tmpdir):
+    ckpt = Checkpoints(str(tmpdir.join('ckpt')))
+    df = pa.DataFrame({'chrom': pa.Categorical(['chr2', 'chr1', 'chr1']),
+                       'start': np.array([0, 0, 1000], dtype=np.int32),
+                       'score': np.array([0.5, np.nan, -1], dtype=np.float32)},
+                      columns=['chrom', 'start', 'score'])
+    key = ckpt.key('scores', None)
+    ckpt.save('scores', key, **Checkpoints.df_as_arrays(df))
+    res = Checkpoints.df_from_arrays(ckpt.load('scores', key))
+    pa.util.testing.assert_frame_equal(res, df)
+
+def test_segments_roundtrip():
+    segments = {'chr1': [util.bed('chr1', 0, 1000, 1.5),
+                         util.bed('chr1', 5000, 7000, 0.25)],
+                'chr2': [util.bed('chr2', 1000, 2000, 3.0)]}
+    arrays = segments_as_arrays(segments)
+    assert segments_from_arrays(**arrays) == segments
@@ -0,0 +1,31 @@
+from eddlib.count_cache import CountCache
+import numpy as np
+import os
+
+chromsizes = {'chr1': 3500, 'chr2': 1200}
+
+def make_bam(tmpdir):
+    p = tmpdir.join('x.bam')
+    p.write('not really a bam file')
+    return str(p)
+
+def test_roundtrip(tmpdir):
+    bam = make_bam(tmpdir)
+    cache = CountCache(str(tmpdir.join('cache')), chromsizes, 1000)
+    assert cache.get(bam) is None
+    counts = {'chr1': np.arange(4, dtype=float), 'chr2': np.ones(2)}
+    cache.put(bam, counts)
+    res = cache.get(bam)
+    assert sorted(res) == ['chr1', 'chr2']
+    for k in counts:
+        assert (res[k] == counts[k]).all()
+
+def test_invalidated(tmpdir):
+    bam = make_bam(tmpdir)
+    cache_dir = str(tmpdir.join('cache'))
+    CountCache(cache_dir, chromsizes, 1000).put(bam, {'chr1': np.ones(4)})
+    assert CountCache(cache_dir, chromsizes, 2000).get(bam) is None
+    assert CountCache(cache_dir, {'chr1': 3500}, 1000).get(bam) is None
+    st = os.stat(bam)
+    os.utime(bam, (st.st_atime, st.st_mtime + 10))
+    assert CountCache(cache_dir, chromsizes, 1000).get(bam) is None
@@ -0,0 +1,40 @@
+from eddlib import count_table
+import numpy as np
+
+chromsizes = {'chr1': 2500, 'chr2': 1000}
+
+def test_read_text_with_header(tmpdir):
+    path = str(tmpdir.join('counts.tsv'))
+    with open(path, 'w') as f:
+        f.write('chrom\tstart\tend\tip\tinput\n')
+        f.write('chr1\t0\t1000\t1\t2\n')
+        # the second bin of chr1 is missing, the last bin is short
+        f.write('chr1\t2000\t2500\t3\t4\n')
+        f.write('chr2\t0\t1000\t5\t6\n')
+        f.write('chrUn\t0\t1000\t7\t8\n')
+    bin_size, ipd, inputd = count_table.read_count_table(path, chromsizes)
+    assert bin_size == 1000
+    assert sorted(ipd) == ['chr1', 'chr2']
+    assert list(ipd['chr1']) == [1, 0, 3]
+    assert list(inputd['chr1']) == [2, 0, 4]
+    assert list(ipd['chr2']) == [5]
+
+def test_read_save_counts_output(tmpdir):
+    path = str(tmpdir.join('counts.tsv'))
+    with open(path, 'w') as f:
+        f.write('chr2\t0\t500\t0.5\t1.5\t2.5\n')
+        f.write('chr2\t500\t1000\tnan\t0\t1\n')
+    bin_size, ipd, inputd = count_table.read_count_table(path, chromsizes)
+    assert bin_size == 500
+    assert list(ipd['chr2']) == [1.5, 0]
+    assert list(inputd['chr2']) == [2.5, 1]
+
+def test_npz_roundtrip(tmpdir):
+    path = str(tmpdir.join('counts.npz'))
+    ipd = {'chr1': np.array([1.0, 2.0, 3.0]), 'chr2': np.array([4.0])}
+    inputd = {'chr1': np.array([5.0, 6.0, 7.0]), 'chr2': np.array([8.0])}
+    count_table.write_npz(path, 1000, ipd, inputd)
+    bin_size, ipd2, inputd2 = count_table.read_count_table(path, chromsizes)
+    assert bin_size == 1000
+    for c in ipd:
+        assert (ipd[c] == ipd2[c]).all() and (inputd[c] == inputd2[c]).all()
@@ -1,5 +1,10 @@
-from eddlib.estimate import golden_section_search
+from eddlib.estimate import golden_section_search, bracketing_search, PrefixSums, \
+    average_ranks, GapPenalty, neighbour_corrcoeff
+from eddlib.experiment import Experiment
+from eddlib import executor
 import numpy as np
+import pandas as pa
+import warnings
 
 def f1(x):
     return -1*(x - 3)**2 + 100
@@ -30,4 +35,75 @@ def test_f3():
     correct_val = xs[idx]
     x = golden_section_search(f3, 0, 30, 40, 0.01)
     assert abs(correct_val - x) < 0.01
-    
+
+def test_bracketing_search():
+    calls = []
+    def fs(points):
+        calls.append(len(points))
+        return [f(x) for x in points]
+    for f in (f1, f2, f3):
+        correct_val = xs[f(xs).argmax()]
+        for nprobes in (2, 5, 8):
+            x = bracketing_search(fs, 0, 40, 0.01, nprobes)
+            assert abs(correct_val - x) < 0.01
+            assert max(calls) == nprobes + 2
+            del calls[:]
+
+def test_prefix_sums_aggregate():
+    rs = np.random.RandomState(0)
+    ipd = {'chr1': rs.poisson(3, 101).astype(float),
+           'chr2': rs.poisson(3, 40).astype(float)}
+    inputd = {'chr1': rs.poisson(2, 101).astype(float),
+              'chr2': rs.poisson(2, 40).astype(float)}
+    exp = Experiment(ipd, inputd, 1000)
+    psums = PrefixSums(exp)
+    for n in (1, 3, 7, 50):
+        agg = exp.aggregate_bins(times_bin_size=n)
+        ip, input = psums.aggregate(n)
+        expected_ip = np.concatenate([agg.ipd['chr1'], [np.nan],
+                                      agg.ipd['chr2'], [np.nan]])
+        assert np.allclose(ip, expected_ip, equal_nan=True)
+        assert np.isclose(np.nansum(input), np.nansum(ip))
+
+def test_average_ranks():
+    assert average_ranks(np.array([3., 1, 3, 2, 3])).tolist() == [4, 1, 4, 2, 4]
+
+def test_neighbour_corrcoeff_undefined():
+    with warnings.catch_warnings(record=True) as ws:
+        warnings.simplefilter('always')
+        for xs in ([], [1.0], [1.0, np.nan, 2.0, np.nan], [2.0, 2.0, 2.0]):
+            assert np.isnan(neighbour_corrcoeff(np.array(xs)))
+    assert ws == []
+    assert neighbour_corrcoeff(np.arange(10.0)) == 1.0
+
+def binscore_df():
+    rs = np.random.RandomState(5)
+    n = 600
+    scores = rs.normal(-0.3, 1, 2 * n)
+    scores[100:180] += 1.5
+    scores[n + 300:n + 420] += 1.0
+    starts = np.tile(np.arange(n) * 1000, 2)
+    return pa.DataFrame({'chrom': ['chr1'] * n + ['chr2'] * n,
+                         'start': starts, 'end': starts + 1000,
+                         'score': scores},
+                        columns=['chrom', 'start', 'end', 'score'])
+
+def test_gap_penalty_search_independent_of_nprocs():
+    df = binscore_df()
+    try:
+        res = [GapPenalty.instantiate(df, nprocs, None, 60, 0.05, seed=3).search(
+                   precision=1.0)
+               for nprocs in (1, 2, 6)]
+    finally:
+        executor.shutdown()
+    assert res[0] == res[1] == res[2]
+
+def test_comp_scores_batch_as_single():
+    df = binscore_df()
+    def scores(gap_penalties):
+        g = GapPenalty.instantiate(df, 1, None, 60, 0.05, seed=3)
+        return g.comp_scores(gap_penalties)
+    try:
+        assert scores([4.0, 11.0]) == scores([4.0]) + scores([11.0])
+    finally:
+        executor.shutdown()
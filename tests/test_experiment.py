@@ -0,0 +1,75 @@
+from eddlib.experiment import BamLoader, Experiment
+from eddlib import logit
+import numpy as np
+import pandas as pa
+import pytest
+
+scores = np.array([[1.0, -2.0, np.nan, 0.5, np.nan],
+                   [3.0, -1.0, 2.0, 0.5, np.nan],
+                   [2.0, 4.0, -1.0, -0.5, np.nan]])
+
+def pandas_merge(scores, which_merge_method):
+    # the dense data frame merge used before the preallocated array
+    df = pa.DataFrame(scores.transpose())
+    if which_merge_method == 'median':
+        return df.median(axis=1).values
+    elif which_merge_method == 'sum':
+        return df.sum(axis=1).values
+    sums = df.dropna().abs().sum(axis=0)
+    return (df / (sums / sums.min())).sum(axis=1).values
+
+@pytest.mark.parametrize('method', ['median', 'sum', 'normalized-sum'])
+def test_merge_scores(method):
+    merged = BamLoader.merge_scores(scores, method)
+    assert np.allclose(merged, pandas_merge(scores, method), equal_nan=True)
+
+def test_merge_scores_illegal_method():
+    with pytest.raises(Exception):
+        BamLoader.merge_scores(scores, 'mean')
+
+def test_as_data_frame_compact():
+    exp = Experiment({'chr2': np.array([1.0, 2.0]), 'chr1': np.array([0.5, 0.0, 3.0])},
+                     {'chr2': np.array([2.0, 2.0]), 'chr1': np.array([1.0, 1.0, 1.0])},
+                     1000)
+    df = exp.as_data_frame(normalize=False)
+    assert list(df.chrom) == ['chr1'] * 3 + ['chr2'] * 2
+    assert df.chrom.dtype.name == 'category'
+    assert list(df.start) == [0, 1000, 2000, 0, 1000]
+    assert (df.end - df.start == 1000).all()
+    assert df.start.dtype == np.int32 and df.ip.dtype == np.float32
+    logit.ci_for_df(df, 'agresti_coull', ci_min=1.0, inplace=True)
+    expected = logit.ci_scores(np.array([0.5, 0.0, 3.0, 1.0, 2.0]),
+                               np.array([1.0, 1.0, 1.0, 2.0, 2.0]),
+                               'agresti_coull', ci_min=1.0)
+    assert np.allclose(df.score, expected, equal_nan=True)
+
+def write_bams(tmpdir):
+    from benchmarks.synthetic import write_bam
+    rs = np.random.RandomState(4)
+    chroms = [('chr1', 25500), ('chr2', 12000), ('chrUn', 5000)]
+    paths = []
+    for name in ('a', 'b'):
+        path = str(tmpdir.join(name + '.bam'))
+        write_bam(path, chroms, [np.sort(rs.randint(0, size - 50, 400))
+                                 for _, size in chroms], 50)
+        paths.append(path)
+    # chrUn is not counted, chr3 is in no bam file
+    return {'chr1': 25500, 'chr2': 12000, 'chr3': 3000}, paths
+
+@pytest.mark.parametrize('kind', ['process', 'thread'])
+def test_read_bams_by_chrom_as_whole_file(tmpdir, kind):
+    from eddlib import executor, read_bam
+    chromsizes, paths = write_bams(tmpdir)
+    expected = [read_bam.read_bam_into_bins(chromsizes, 1000, p) for p in paths]
+    bam_refs = [set(read_bam.indexed_references(p)) for p in paths]
+    ex = executor.Executor(2, kind)
+    try:
+        res = Experiment.read_bams_by_chrom(chromsizes, 1000, paths, bam_refs, ex)
+    finally:
+        ex.shutdown()
+    assert len(res) == len(expected)
+    for d, e in zip(res, expected):
+        assert sorted(d) == ['chr1', 'chr2']
+        for chrom in d:
+            assert np.array_equal(d[chrom], e[chrom])
+        assert np.isclose(d['chr1'].sum(), 400)
@@ -0,0 +1,30 @@
+from eddlib.instrument import RunReport
+import json
+import time
+import pytest
+
+@pytest.mark.parametrize('per_stage_peak_rss', [True, False])
+def test_run_report_stages(tmpdir, per_stage_peak_rss):
+    report = RunReport(per_stage_peak_rss=per_stage_peak_rss)
+    with report.stage('a') as d:
+        d['bins'] = 10
+        time.sleep(0.01)
+    with report.stage('b'):
+        pass
+    path = str(tmpdir.join('report.json'))
+    report.save(path)
+    saved = json.load(open(path))
+    assert saved['per_stage_peak_rss'] == per_stage_peak_rss
+    stages = saved['stages']
+    assert [x['name'] for x in stages] == ['a', 'b']
+    assert stages[0]['bins'] == 10
+    assert stages[0]['seconds'] >= 0.01
+    assert stages[1]['seconds'] >= 0
+    assert saved['total_seconds'] >= stages[0]['seconds'] + stages[1]['seconds']
+    for x in stages:
+        assert 'rss_before_mb' in x and 'rss_after_mb' in x
+        assert x['children_peak_rss_mb'] is not None
+        if per_stage_peak_rss:
+            assert x['peak_rss_mb'] > 0
+        else:
+            assert x['peak_rss_mb'] is None
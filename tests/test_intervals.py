@@ -0,0 +1,28 @@
+from eddlib.algorithm.intervals import BinIndex
+import numpy as np
+
+chroms = ['chr1'] * 5 + ['chr2'] * 3
+starts = [0, 10, 20, 30, 40, 20, 0, 10]
+ends = [10, 20, 30, 40, 50, 30, 10, 20]
+scores = [1.0, -1.0, 2.0, 0.0, 3.0, 1.0, -2.0, 1.0]
+index = BinIndex(chroms, starts, ends, scores)
+
+def naive_stats(qchroms, qstarts, qends):
+    stats = {'EIB': 0, 'DIB': 0}
+    for qc, qs, qe in zip(qchroms, qstarts, qends):
+        for c, s, e, x in zip(chroms, starts, ends, scores):
+            if c == qc and s < qe and qs < e:
+                stats['EIB' if x > 0 else 'DIB'] += 1
+    return stats
+
+def test_genome_wide_stats():
+    assert index.genome_wide_stats() == {'EIB': 5, 'DIB': 3}
+
+def test_count_stats():
+    queries = (['chr1', 'chr1', 'chr2', 'chr3', 'chr1'],
+               [0, 25, 5, 0, 50],
+               [20, 41, 30, 100, 60])
+    assert index.count_stats(*queries) == naive_stats(*queries)
+
+def test_no_intervals():
+    assert index.count_stats([], [], []) == {'EIB': 0, 'DIB': 0}
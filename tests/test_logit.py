@@ -0,0 +1,33 @@
+from eddlib import logit
+import numpy as np
+import pytest
+
+def test_ci_widths_as_statsmodels():
+    proportion = pytest.importorskip('statsmodels.stats.proportion')
+    rs = np.random.RandomState(0)
+    count = np.concatenate([rs.poisson(3, 1000) * 1.0, rs.uniform(0, 40, 1000)])
+    nobs = count + np.concatenate([rs.poisson(3, 1000) * 1.07 + 0.5,
+                                   rs.uniform(0, 40, 1000)])
+    for method in logit.ci_methods:
+        low, upp = proportion.proportion_confint(count, nobs, method=method)
+        assert np.allclose(logit.ci_widths(count, nobs, method), upp - low,
+                           rtol=0, atol=1e-12), method
+
+def test_unique_pairs():
+    xs = np.array([1, 2, 1, 2, 3.5], dtype=np.float32)
+    ys = np.array([3, 4, 3, 5, 3.5], dtype=np.float32)
+    us, vs, codes = logit.unique_pairs(xs, ys)
+    assert len(us) == 4 and us.dtype == np.float32
+    assert (us[codes] == xs).all() and (vs[codes] == ys).all()
+
+def test_ci_scores_memoized():
+    rs = np.random.RandomState(1)
+    ip = rs.poisson(2, 5000).astype(float)
+    input = rs.poisson(2, 5000) * 1.07
+    for method in logit.beta_ci_methods:
+        scores = logit.ci_scores(ip, input, method, ci_min=0.5)
+        m = np.logical_and(ip > 0, input > 0)
+        width = logit.ci_widths(ip[m], ip[m] + input[m], method)
+        expected = np.where(width < 0.5, logit.logit(ip[m] / (ip[m] + input[m])), np.nan)
+        assert np.isnan(scores[~m]).all()
+        assert np.allclose(scores[m], expected, equal_nan=True)
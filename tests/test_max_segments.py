@@ -0,0 +1,112 @@
+from eddlib.algorithm import max_segments as ms
+from eddlib.algorithm.chrom_max_segments import max_segments
+from eddlib.algorithm.max_segments import GenomeBins
+from eddlib import executor
+from eddlib import util
+import numpy as np
+import threading
+import pytest
+
+def random_bins():
+    rs = np.random.RandomState(3)
+    lengths = [0, 500, 1, 2000, 300]
+    names = ['chr%d' % i for i in range(len(lengths))]
+    starts = np.concatenate([np.arange(n) * 1000 for n in lengths])
+    return GenomeBins(names, names, np.concatenate(([0], np.cumsum(lengths))),
+                      starts, starts + 1000, rs.normal(-0.2, 1, len(starts)))
+
+def test_segment_array_as_kernel():
+    gb = random_bins()
+    segs = gb.segment_array(filter_trivial=0.5, nthreads=1)
+    expected = []
+    for i, name in enumerate(gb.names):
+        expected.extend((i, x.score, gb.offsets[i] + x.from_idx,
+                         gb.offsets[i] + x.to_idx)
+                        for x in max_segments(gb.chrom_scores[name])
+                        if x.score > 0.5)
+    assert segs.tolist() == expected
+
+def test_segment_array_threads(monkeypatch):
+    gb = random_bins()
+    monkeypatch.setattr(ms, 'min_bins_per_thread', 10)
+    serial = gb.max_segments(nthreads=1)
+    threaded = gb.max_segments(nthreads=3)
+    assert serial == threaded
+    assert sum(len(xs) for xs in serial.values()) == len(gb.segment_array())
+
+def test_segment_array_executor(monkeypatch):
+    gb = random_bins()
+    monkeypatch.setattr(ms, 'min_bins_per_thread', 10)
+    expected = gb.segment_array(nthreads=1)
+    try:
+        executor.configure(3, 'process')
+        ex = executor.threads()
+        assert ex.kind == 'thread' and ex.nworkers == 3
+        # one pool, shared by calls with any number of batches
+        for nthreads in (2, 3, 5):
+            assert (gb.segment_array(nthreads=nthreads) == expected).all()
+        assert executor.threads() is ex
+        executor.configure(3, 'serial')
+        assert executor.threads().kind == 'serial'
+        assert (gb.segment_array(nthreads=3) == expected).all()
+    finally:
+        executor.shutdown()
+
+def test_segment_array_concurrent(monkeypatch):
+    # e.g. edd batch -j 2 with samples of different bin sizes
+    gb = random_bins()
+    monkeypatch.setattr(ms, 'min_bins_per_thread', 10)
+    expected = gb.segment_array(nthreads=1)
+    results, errors = [], []
+    def run(nthreads):
+        try:
+            for _ in range(20):
+                results.append((gb.segment_array(nthreads=nthreads) == expected).all())
+        except Exception as e:
+            errors.append(e)
+    try:
+        executor.configure(3, 'process')
+        ts = [threading.Thread(target=run, args=(n,)) for n in (2, 3)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+    finally:
+        executor.shutdown()
+    assert errors == []
+    assert len(results) == 40 and all(results)
+
+def naive_max_segments(xs):
+    'Ruzzo and Tompa without the links between segments'
+    buf, csum = [], 0.0
+    for i, x in enumerate(xs):
+        L, csum = csum, csum + x
+        if x <= 0:
+            continue
+        s = [L, csum, i, i]
+        while True:
+            j = len(buf) - 1
+            while j >= 0 and buf[j][0] >= s[0]:
+                j -= 1
+            if j == -1 or buf[j][1] >= s[1]:
+                break
+            s = [buf[j][0], s[1], buf[j][2], i]
+            del buf[j:]
+        buf.append(s)
+    return [(R - L, lidx, ridx) for L, R, lidx, ridx in buf]
+
+def test_kernel_as_naive():
+    rs = np.random.RandomState(2)
+    for _ in range(200):
+        xs = rs.normal(rs.uniform(-1, 0.5), 1, rs.randint(0, 300))
+        assert [(x.score, x.from_idx, x.to_idx)
+                for x in max_segments(xs)] == naive_max_segments(xs)
+
+def test_fdr_bh():
+    qvals = util.fdr_bh([0.01, 0.04, 0.03, 0.04, 0.5])
+    assert np.allclose(qvals, [0.05, 0.05, 0.05, 0.05, 0.5])
+    multicomp = pytest.importorskip('statsmodels.sandbox.stats.multicomp')
+    pvals = np.random.RandomState(0).uniform(size=1000) ** 3
+    pvals[::10] = pvals[0]
+    assert np.array_equal(util.fdr_bh(pvals),
+                          multicomp.multipletests(pvals, method='fdr_bh')[1])
@@ -0,0 +1,34 @@
+from eddlib.algorithm.monte_carlo import FdrDecisionRule, MonteCarlo
+from eddlib import executor
+import numpy as np
+
+rs = np.random.RandomState(0)
+mc_res = np.sort(rs.normal(10, 2, 2000))
+
+def test_clear_decisions_stop():
+    rule = FdrDecisionRule([30.0, 40.0, 5.0, 8.0], 0.05, min_trials=100)
+    assert rule(mc_res)
+
+def test_borderline_decision_continues():
+    # true pvalue close to the fdr limit
+    borderline = np.percentile(mc_res, 95.5)
+    rule = FdrDecisionRule([borderline], 0.05, min_trials=100)
+    assert not rule(mc_res)
+
+def test_min_trials():
+    rule = FdrDecisionRule([30.0], 0.05, min_trials=5000)
+    assert not rule(mc_res)
+
+def test_seeded_simulation_independent_of_nprocs():
+    scores = {'chr1': rs.normal(-0.2, 1, 300), 'chr2': rs.normal(-0.2, 1, 200)}
+    try:
+        res = [MonteCarlo.run_simulation(scores, niter=40, nprocs=nprocs, seed=7)
+               for nprocs in (1, 2, 3)]
+        executor.configure(2, 'thread')
+        res.append(MonteCarlo.run_simulation(scores, niter=40, nprocs=2, seed=7))
+    finally:
+        executor.shutdown()
+    for xs in res[1:]:
+        assert (res[0] == xs).all()
+    other = MonteCarlo.run_simulation(scores, niter=40, nprocs=1, seed=8)
+    assert not (res[0] == other).all()
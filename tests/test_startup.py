@@ -0,0 +1,12 @@
+from benchmarks import startup
+
+def test_help_is_lazy():
+    for name, cmd in startup.commands:
+        if name != 'import pipeline':
+            assert startup.time_command(cmd, 1)['loaded'] == [], name
+
+def test_pipeline_without_statsmodels():
+    cmd = dict(startup.commands)['import pipeline']
+    loaded = startup.time_command(cmd, 1)['loaded']
+    assert 'statsmodels' not in loaded
+    assert 'scipy.stats' not in loaded
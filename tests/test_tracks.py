@@ -0,0 +1,75 @@
+from eddlib import tracks
+from eddlib import util
+from eddlib.algorithm.max_segments import IntervalTest
+import numpy as np
+import pandas as pa
+import StringIO
+import gzip
+
+def bin_df(n=1000):
+    rs = np.random.RandomState(0)
+    df = pa.DataFrame({
+        'chrom': pa.Categorical(np.where(np.arange(n) % 3 == 0, 'chr2', 'chr10')),
+        'start': rs.permutation(n).astype(np.int32) * 1000},
+        columns=['chrom', 'start'])
+    df['end'] = df.start + 1000
+    df['score'] = rs.normal(size=n).astype(np.float32)
+    df.loc[::7, 'score'] = np.nan
+    df['log_ratio'] = rs.normal(size=n)
+    return df
+
+def test_bedgraph_as_to_csv(tmpdir, monkeypatch):
+    monkeypatch.setattr(tracks, 'chunk_rows', 64)
+    df = bin_df()
+    expected = df['chrom start end score log_ratio'.split()].sort_values(
+        by=['chrom', 'start']).to_csv(sep='\t', index=False, header=False)
+    path = str(tmpdir.join('a.bedgraph'))
+    tracks.write_track(path, df.chrom, df.start.values, df.end.values,
+                       [df.score.values, df.log_ratio.values])
+    assert open(path).read() == expected
+    util.save_bin_score_file(df, path)
+    assert open(path).read() == df['chrom start end score'.split()].sort_values(
+        by=['chrom', 'start']).to_csv(sep='\t', index=False, header=False)
+
+def test_bgzf(tmpdir):
+    df = bin_df(50000)
+    path = str(tmpdir.join('a.bedgraph'))
+    util.save_bin_score_file(df, path)
+    for nthreads in (1, 3):
+        gz_path = str(tmpdir.join('a%d.bedgraph.gz' % nthreads))
+        util.save_bin_score_file(df, gz_path, fmt='bedgraph.gz',
+                                 nthreads=nthreads)
+        assert gzip.open(gz_path).read() == open(path).read()
+        assert tmpdir.join('a%d.bedgraph.gz.tbi' % nthreads).check()
+    assert (open(str(tmpdir.join('a1.bedgraph.gz')), 'rb').read() ==
+            open(str(tmpdir.join('a3.bedgraph.gz')), 'rb').read())
+
+def test_npz_track(tmpdir):
+    df = bin_df()
+    path = str(tmpdir.join('a.npz'))
+    util.save_bin_score_file(df, path, fmt='npz')
+    t = tracks.NpzTrack(path)
+    assert t.chroms == ['chr10', 'chr2']
+    starts, ends, values = t.query('chr2', 10500, 13000)
+    x = df[(df.chrom == 'chr2') & (df.end > 10500) &
+           (df.start < 13000)].sort_values('start')
+    assert (starts == x.start.values).all()
+    assert (ends == x.end.values).all()
+    assert np.allclose(values[:, 0], x.score.values, equal_nan=True)
+
+def test_segments_to_bedstream():
+    segments = [util.bed('chr1', 0, 1000, 1.5), util.bed('chr2', 10, 20, 1.0 / 3),
+                util.bed('chr1', 5000, 6000, 2.0)]
+    f = StringIO.StringIO()
+    IntervalTest.segments_to_bedstream(segments, f)
+    assert f.getvalue() == ''.join('\t'.join((x.chrom, str(x.start), str(x.end),
+                                              str(x.score))) + '\n'
+                                   for x in segments)
+
+def test_bgzf_without_gz_suffix(tmpdir):
+    df = bin_df()
+    path = str(tmpdir.join('a.bedgraph'))
+    util.save_bin_score_file(df, path, fmt='bedgraph.gz')
+    assert sorted(x.basename for x in tmpdir.listdir()) == ['a.bedgraph']
+    assert gzip.open(path).read() == df['chrom start end score'.split()].sort_values(
+        by=['chrom', 'start']).to_csv(sep='\t', index=False, header=False)
@@ -0,0 +1,25 @@
+from eddlib.algorithm.unalignable_regions import UnalignableRegions
+import numpy as np
+
+regions = UnalignableRegions(['chr1'] * 4 + ['chr2'],
+                             [50, 10, 15, 30, 0],
+                             [60, 20, 30, 35, 5])
+
+def test_merge():
+    # overlapping and book-ended regions are merged
+    assert list(regions.starts['chr1']) == [10, 50]
+    assert list(regions.ends['chr1']) == [35, 60]
+    assert len(regions) == 3
+    assert regions.coverage() == 25 + 10 + 5
+
+def test_split_runs():
+    starts = np.arange(0, 80, 10)
+    keep, runs = regions.split_runs('chr1', starts, starts + 10)
+    assert list(keep) == [0, 4, 6, 7]
+    assert list(runs) == [0, 1, 2, 2]
+
+def test_split_runs_unknown_chrom():
+    starts = np.arange(0, 30, 10)
+    keep, runs = regions.split_runs('chr3', starts, starts + 10)
+    assert list(keep) == [0, 1, 2]
+    assert list(runs) == [0, 0, 0]